@@ -3,7 +3,9 @@ monkey.patch_all() # Patch standard libraries for non-blocking I/O to enable Gev
 
 import logging
 from flask import Flask, jsonify, render_template_string
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+import orjson
 from pathlib import Path
 from dotenv import load_dotenv
 import datetime
@@ -12,9 +14,23 @@ import datetime
 env_path = Path(__file__).parent.resolve() / ".env"
 load_dotenv(dotenv_path=env_path)
 
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson for request parsing and jsonify responses."""
+
+    def dumps(self, obj, **kwargs):
+        # Datetimes go through Flask's default hook so responses keep the HTTP date format
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 def create_app():
     """Create and configure an instance of the Flask application."""
     app = Flask(__name__)
+    app.json = OrjsonProvider(app)
 
     # 0. Initialize a simple in-memory cache for interruption flags and file uploads
     app.interrupt_requests = {}
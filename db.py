@@ -1,13 +1,32 @@
 ﻿import psycopg2
-from psycopg2 import pool, sql
+from psycopg2 import extensions, pool, sql
 from psycopg2.extras import RealDictCursor
+from gevent import monkey
+from gevent.socket import wait_read, wait_write
 import logging
+import weakref
 from flask import current_app, g
 from contextlib import contextmanager
 
 # Global connection pool
 connection_pool = None
 
+# Names of server-side prepared statements already created on each pooled connection
+_prepared_statements = weakref.WeakKeyDictionary()
+
+def _gevent_wait_callback(conn, timeout=None):
+    """Wait for libpq socket readiness through the gevent hub instead of blocking it."""
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Bad result from poll: {state!r}")
+
 def init_connection_pool():
     """Initialize PostgreSQL connection pool."""
     global connection_pool
@@ -16,6 +35,10 @@ def init_connection_pool():
         logging.info("Connection pool already initialized")
         return
 
+    # libpq I/O is invisible to monkey patching; yield to other greenlets while queries run
+    if monkey.is_module_patched('socket'):
+        extensions.set_wait_callback(_gevent_wait_callback)
+
     try:
         connection_pool = psycopg2.pool.ThreadedConnectionPool(        
             current_app.config['DB_POOL_MIN_CONNECTIONS'],
@@ -56,6 +79,58 @@ def return_db_connection(conn):
     if connection_pool is not None and conn is not None:
         connection_pool.putconn(conn)
 
+def execute_prepared(cursor, name, statement, params):
+    """
+    Execute a server-side prepared statement, issuing PREPARE the first time
+    it is used on the cursor's connection. Placeholders in statement are $1..$n.
+    """
+    prepared = _prepared_statements.setdefault(cursor.connection, set())
+    # A StatementBatch only queues the PREPARE, so it is recorded once the batch is sent
+    pending = getattr(cursor, 'pending_prepares', None)
+    if name not in prepared and (pending is None or name not in pending):
+        cursor.execute(f"PREPARE {name} AS {statement}")
+        (prepared if pending is None else pending).add(name)
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+def reset_prepared_statements(conn):
+    """Drop every prepared statement on conn (after rollback) so the next use re-PREPAREs."""
+    conn.cursor().execute("DEALLOCATE ALL")
+    _prepared_statements.pop(conn, None)
+
+class StatementBatch:
+    """
+    Queues statements for a cursor and sends them as one multi-statement query,
+    so a burst of writes costs a single round trip. Exposes the execute/mogrify/
+    connection surface that execute_prepared and execute_values rely on.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.connection = cursor.connection
+        self._statements = []
+        self.pending_prepares = set()
+
+    def mogrify(self, query, params=None):
+        return self.cursor.mogrify(query, params)
+
+    def execute(self, query, params=None):
+        self._statements.append(self.cursor.mogrify(query, params))
+
+    def flush(self):
+        """Send every queued statement; the caller still owns commit/rollback."""
+        if not self._statements:
+            return
+        statements, self._statements = self._statements, []
+        pending, self.pending_prepares = self.pending_prepares, set()
+        try:
+            self.cursor.execute(b";\n".join(statements))
+        except Exception:
+            # A queued PREPARE may or may not have run, so reset this connection's prepared state
+            self.connection.rollback()
+            reset_prepared_statements(self.connection)
+            raise
+        _prepared_statements.setdefault(self.connection, set()).update(pending)
+
 @contextmanager
 def get_db():
     """Context manager for database connections."""
@@ -228,6 +303,28 @@ def init_db():
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
 
+        CREATE TABLE IF NOT EXISTS gmail_oauth_states (
+            state TEXT COLLATE "C" PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            session_id VARCHAR(50),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Byte-wise collation keeps state lookups a plain memcmp B-tree probe;
+        -- only rewrite older tables, so boots don't take an ACCESS EXCLUSIVE lock
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema()
+                  AND table_name = 'gmail_oauth_states'
+                  AND column_name = 'state'
+                  AND collation_name IS DISTINCT FROM 'C'
+            ) THEN
+                ALTER TABLE gmail_oauth_states ALTER COLUMN state TYPE TEXT COLLATE "C";
+            END IF;
+        END $$;
+
         CREATE INDEX IF NOT EXISTS idx_search_realtime_cache
         ON search_web_realtime_cache (user_id, session_number, updated_at);
 
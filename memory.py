@@ -1,10 +1,10 @@
-﻿import json
+﻿import orjson
 import logging
 import sqlite3
 from datetime import datetime, timezone
 from flask import current_app
-from together import Together
-from db import get_db_connection, return_db_connection
+from together_client import get_together_client
+from db import execute_prepared, get_db_connection, return_db_connection
 
 class TokenAwareMemoryManager:
     def __init__(self, user_id, session_number):
@@ -26,6 +26,9 @@ class TokenAwareMemoryManager:
         self.adaptive_threshold = self.tok_K * self.safety_margin
         self.current_token_sum = 0
 
+        # id of the chat_history row written by the latest add_interaction
+        self.last_chat_id = None
+
         self._load_from_db()
 
     def _calculate_dynamic_threshold(self):
@@ -161,9 +164,9 @@ class TokenAwareMemoryManager:
         })
         self.token_buffer.append(total_token_count)
 
-        logging.info(f"Added interaction: {len(self.history_buffer)} total, "
-                    f"{sum(self.token_buffer)} total tokens "
-                    f"(input: {input_token_count}, output: {output_token_count})")
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("Added interaction: %d total, %d total tokens (input: %d, output: %d)",
+                         len(self.history_buffer), sum(self.token_buffer), input_token_count, output_token_count)
 
         # Check if summarization should be triggered
         if self._should_trigger_summarization():
@@ -174,13 +177,17 @@ class TokenAwareMemoryManager:
         conn = get_db_connection()
         try:
             cursor = conn.cursor()
-            # Insert into chat_history
-            cursor.execute(
+            # Insert into chat_history; runs every turn, so it is prepared once per connection
+            execute_prepared(
+                cursor,
+                "insert_chat_history",
                 """INSERT INTO chat_history
                 (user_id, session_number, prompt, response, timestamp, token_count, original_prompt)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
+                RETURNING id""",
                 (self.user_id, self.session_number, prompt, response, timestamp, token_count, original_prompt)
             )
+            chat_id = cursor.fetchone()['id']
 
             # Insert into token_usage for analytics
             cursor.execute(
@@ -200,8 +207,10 @@ class TokenAwareMemoryManager:
                 )
             )
             conn.commit()
+            self.last_chat_id = chat_id
         except Exception as e:
             conn.rollback()
+            self.last_chat_id = None
             logging.error(f"Failed to log interaction to database: {e}", exc_info=True)
         finally:
             return_db_connection(conn)
@@ -221,7 +230,7 @@ class TokenAwareMemoryManager:
         if row:
             self.summary_json = row['summary_json']
             if row['history_buffer']:
-                loaded_buffer = json.loads(row['history_buffer'])
+                loaded_buffer = orjson.loads(row['history_buffer'])
                 self.history_buffer = loaded_buffer
 
                 # Reconstruct token buffer from history buffer (handle both old and new formats)
@@ -251,7 +260,7 @@ class TokenAwareMemoryManager:
                     last_updated = excluded.last_updated
                 """,
                 (self.user_id, self.session_number, self.summary_json,
-                 json.dumps(self.history_buffer), datetime.now(timezone.utc).isoformat())
+                 orjson.dumps(self.history_buffer).decode(), datetime.now(timezone.utc).isoformat())
             )
             conn.commit()
         finally: 
@@ -264,16 +273,16 @@ class TokenAwareMemoryManager:
         # Add long-term memory summary
         if self.summary_json:
             try:
-                summary_data = json.loads(self.summary_json)
+                summary_data = orjson.loads(self.summary_json)
                 combined_summary_text = "Here is a summary of the conversation so far:\n"
                 interactions = summary_data.get('interactions', [])
                 details = summary_data.get('important_details', [])
                 if interactions:
-                    combined_summary_text += f"- Key topics discussed: {json.dumps(interactions)}\n"
+                    combined_summary_text += f"- Key topics discussed: {orjson.dumps(interactions).decode()}\n"
                 if details:
                     combined_summary_text += f"- Important details to remember: {', '.join(details)}\n"
                 messages.append({"role": "system", "content": combined_summary_text})
-            except (json.JSONDecodeError, TypeError):
+            except (orjson.JSONDecodeError, TypeError):
                 logging.warning(f"Could not parse summary JSON for context: {self.summary_json}")
 
         # Add short-term memory
@@ -307,7 +316,7 @@ class TokenAwareMemoryManager:
 class Summarizer:
     """Enhanced summarizer remains the same as your current implementation"""
     def __init__(self):
-        self.client = Together(api_key=current_app.config['TOGETHER_API_KEY'])
+        self.client = get_together_client(current_app.config['TOGETHER_API_KEY'])
         self.model = current_app.config['SUMMARIZER_LLM']
 
     def summarize(self, previous_summary_json, conversation_log):
@@ -318,11 +327,11 @@ class Summarizer:
         formatted_log = ""
         if previous_summary_json:
             try:
-                summary_data = json.loads(previous_summary_json)
+                summary_data = orjson.loads(previous_summary_json)
                 formatted_log += f"Previous Summary:\n"
-                formatted_log += f"- Interactions: {json.dumps(summary_data.get('interactions', []))}\n"
+                formatted_log += f"- Interactions: {orjson.dumps(summary_data.get('interactions', [])).decode()}\n"
                 formatted_log += f"- Important Details: {', '.join(summary_data.get('important_details', []))}\n\n"
-            except (json.JSONDecodeError, TypeError):
+            except (orjson.JSONDecodeError, TypeError):
                 logging.warning(f"Could not parse previous summary: {previous_summary_json}")
 
         for interaction in conversation_log:
@@ -366,7 +375,7 @@ Rules:
                 response_format={"type": "json_object", "schema": current_app.config['CONVERSATION_SUMMARY_SCHEMA']},
             )
             summary_json_str = response.choices[0].message.content
-            json.loads(summary_json_str) # Validate JSON
+            orjson.loads(summary_json_str) # Validate JSON
             logging.info(f"Successfully generated summary: {len(summary_json_str)} characters")
             return summary_json_str
         except Exception as e:
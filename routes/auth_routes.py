@@ -6,19 +6,25 @@ from psycopg2 import IntegrityError
 from db import get_db_connection, return_db_connection
 from auth import create_access_token, get_user, token_required
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
 from google.oauth2.credentials import Credentials
+import gevent
+import html
 import logging
 import secrets
 import json
 import sys
-import traceback
 
 auth_bp = Blueprint('auth_bp', __name__)
 
+# Shared transport so ID token verification reuses a warm HTTPS connection to Google's cert endpoint
+_google_request = google_requests.Request()
+
+# Verified against when the email is unknown (or has no password) so every login does one hash check
+_DUMMY_PASSWORD_HASH = generate_password_hash(secrets.token_hex(16), method='pbkdf2:sha256')
+
 @auth_bp.route('/signup', methods=['POST'])
 def signup():
-    data = request.get_json()
+    data = request.get_json(cache=False)
     email = data.get('email')
     password = data.get('password')
     username = data.get('username')
@@ -41,14 +47,16 @@ def signup():
 
 @auth_bp.route('/login', methods=['POST'])
 def login():
-    data = request.get_json()
+    data = request.get_json(cache=False)
     email = data.get('email')
     password = data.get('password')
     if not email or not password:
         return jsonify({'message': 'Email and password are required'}), 400
 
     user = get_user(email)
-    if not user or not check_password_hash(user['password'], password):
+    hashed_password = user['password'] if user and user['password'] else _DUMMY_PASSWORD_HASH
+    password_ok = check_password_hash(hashed_password, password)
+    if not user or not user['password'] or not password_ok:
         return jsonify({'message': 'Invalid credentials'}), 401
 
     access_token = create_access_token(data={"sub": user['email']})
@@ -63,49 +71,40 @@ def login():
 
 @auth_bp.route('/google-login', methods=['POST'])
 def google_login():
-    data = request.get_json(force=True)
+    data = request.get_json(force=True, cache=False)
     token = data.get("token")
     if not token:
         return jsonify({'message': 'Missing token'}), 400
 
     try:
-        idinfo = id_token.verify_oauth2_token(token, google_requests.Request(), current_app.config['GOOGLE_CLIENT_ID'])
+        idinfo = id_token.verify_oauth2_token(token, _google_request, current_app.config['GOOGLE_CLIENT_ID'])
         email = idinfo.get("email")
         if not email or not idinfo.get("email_verified"):
             return jsonify({'message': 'Invalid or unverified email token'}), 400
 
-        user = get_user(email)
         profile_picture = idinfo.get("picture")
-        if user is None:
-            username = idinfo.get("name", email.split("@")[0])
-            conn = get_db_connection()
-            try:
-                cursor = conn.cursor()
-                cursor.execute("INSERT INTO users (username, email, profile_picture) VALUES (%s, %s, %s)", 
-(username, email, profile_picture))
-                conn.commit()
-            except IntegrityError as e:
-                if "username" in str(e):
-                    return jsonify({'message': 'Username Already exist please login manually!'}), 409      
-                else:
-                    current_app.logger.error(f"IntegrityError when creating user {email}: {e}")
-                    return jsonify({'message': 'Failed to create user due to database constraint violation.'}), 500
-            finally:
-                return_db_connection(conn)
-            user = get_user(email)
-            if user is None:
-                return jsonify({'message': 'Failed to retrieve user after creation'}), 500
-        else:
-            # Update profile picture if user already exists and picture is available
-            conn = get_db_connection()
-            try:
-                cursor = conn.cursor()
-                cursor.execute("UPDATE users SET profile_picture = %s WHERE id = %s ", (profile_picture, user['id']))
-                conn.commit()
-            except Exception as e:
-                current_app.logger.error(f"Error updating profile picture for user {user['id']}: {e}")     
-            finally:
-                return_db_connection(conn)
+        username = idinfo.get("name", email.split("@")[0])
+        # Create the user or refresh the profile picture of an existing one in a single round trip
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                """INSERT INTO users (username, email, profile_picture) VALUES (%s, %s, %s)
+                   ON CONFLICT (email) DO UPDATE SET profile_picture = EXCLUDED.profile_picture
+                   RETURNING id, email, username, profile_picture""",
+                (username, email, profile_picture)
+            )
+            user = cursor.fetchone()
+            conn.commit()
+        except IntegrityError as e:
+            # Email conflicts are handled by the upsert, so this is a username clash with another account
+            if "username" in str(e):
+                return jsonify({'message': 'Username Already exist please login manually!'}), 409
+            else:
+                current_app.logger.error(f"IntegrityError when creating user {email}: {e}")
+                return jsonify({'message': 'Failed to create user due to database constraint violation.'}), 500
+        finally:
+            return_db_connection(conn)
 
         access_token = create_access_token(data={"sub": email})
         return jsonify({
@@ -119,21 +118,45 @@ def google_login():
 
 # -------GMAIL AUTHENTICATION ROUTES-------
 
+# Callback pages are built once at import; dynamic values are HTML-escaped before substitution
+_CALLBACK_FAILED_HTML = """
+    <html><body style="font-family: Arial, sans-serif; text-align: center; padding: 50px;">
+    <h2>Authentication Failed</h2>
+    <p>%s</p>
+    <p>Please close this window and try again.</p>
+    </body></html>
+"""
+
+_CALLBACK_MISSING_STATE_HTML = """
+    <html><body style="font-family: Arial, sans-serif; text-align: center; padding: 50px;">
+    <h2>Authentication Failed</h2>
+    <p>Missing state parameter. Please try again.</p>
+    </body></html>
+"""
+
+_CALLBACK_INVALID_STATE_HTML = """
+    <html><body style="font-family: Arial, sans-serif; text-align: center; padding: 50px;">
+    <h2>Authentication Failed</h2>
+    <p>Session expired or invalid. Please try again.</p>
+    </body></html>
+"""
+
+_CALLBACK_SUCCESS_HTML = """
+    <html><body style="font-family: Arial, sans-serif; text-align: center; padding: 50px;">
+    <h2>Gmail Connected!</h2>
+    <p>Connected as: %s</p>
+    <p>This window will close automatically...</p>
+    <script>setTimeout(function(){ window.close(); }, 1500);</script>
+    </body></html>
+"""
+
 def _store_oauth_state(state: str, user_id: int, session_id: str):
     """Store OAuth state in database for retrieval after callback."""
     print(f"[OAUTH] Storing state: {state[:20]}... for user_id={user_id}, session_id={session_id}", file=sys.stdout, flush=True)
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        # Create table if not exists
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS gmail_oauth_states (
-                state VARCHAR(200) PRIMARY KEY,
-                user_id INTEGER NOT NULL,
-                session_id VARCHAR(50),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        # gmail_oauth_states is created once at startup by init_db()
         # Clean up old states (older than 10 minutes)
         cursor.execute("DELETE FROM gmail_oauth_states WHERE created_at < NOW() - INTERVAL '10 minutes'")
         # Insert new state
@@ -156,16 +179,15 @@ def _get_oauth_state(state: str):
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
+        # Consume the state in a single index probe
         cursor.execute(
-            "SELECT user_id, session_id FROM gmail_oauth_states WHERE state = %s",
+            "DELETE FROM gmail_oauth_states WHERE state = %s RETURNING user_id, session_id",
             (state,)
         )
         result = cursor.fetchone()
+        conn.commit()
         if result:
             print(f"[OAUTH] State found! user_id={result['user_id']}, session_id={result['session_id']}", file=sys.stdout, flush=True)
-            # Delete the used state
-            cursor.execute("DELETE FROM gmail_oauth_states WHERE state = %s", (state,))
-            conn.commit()
             return result['user_id'], result['session_id']
         else:
             print(f"[OAUTH ERROR] State NOT found in database!", file=sys.stdout, flush=True)
@@ -183,6 +205,58 @@ def _get_oauth_state(state: str):
         return_db_connection(conn)
 
 
+def _finalize_gmail_connection(app, user_id, session_id, credentials, email_address):
+    """Store the Gmail tokens and notify any waiting email tool agent."""
+    with app.app_context():
+        try:
+            # Store tokens in database
+            print(f"[CALLBACK] Storing tokens in database...", file=sys.stdout, flush=True)
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO user_gmail_tokens (user_id, access_token, refresh_token, token_expiry, email_address)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        access_token = excluded.access_token,
+                        refresh_token = excluded.refresh_token,
+                        token_expiry = excluded.token_expiry,
+                        email_address = excluded.email_address,
+                        updated_at = CURRENT_TIMESTAMP
+                """, (
+                    user_id,
+                    credentials.token,
+                    credentials.refresh_token,
+                    credentials.expiry.isoformat() if credentials.expiry else None,
+                    email_address
+                ))
+                conn.commit()
+                print(f"[CALLBACK] Tokens stored successfully!", file=sys.stdout, flush=True)
+                logging.info(f"Gmail tokens stored for user {user_id}, email: {email_address}")
+
+            finally:
+                return_db_connection(conn)
+        except Exception as e:
+            logging.error(f"Failed to store Gmail tokens for user {user_id}: {e}", exc_info=True)
+            return
+
+        # Notify waiting email tool agent
+        if session_id:
+            try:
+                from tools.email_tool.agent import get_active_agent
+                agent = get_active_agent(user_id, session_id)
+                if agent:
+                    agent.set_auth_completed(True)
+                    print(f"[CALLBACK] Notified agent for user {user_id}, session {session_id}", file=sys.stdout, flush=True)
+                    logging.info(f"Notified agent for user {user_id}, session {session_id}")
+                else:
+                    print(f"[CALLBACK] No active agent for user {user_id}, session {session_id}", file=sys.stdout, flush=True)
+                    logging.info(f"No active agent for user {user_id}, session {session_id}")
+            except Exception as e:
+                print(f"[CALLBACK WARNING] Could not notify agent: {e}", file=sys.stdout, flush=True)
+                logging.warning(f"Could not notify agent: {e}")
+
+
 @auth_bp.route('/auth/gmail/authorize')
 @token_required
 def gmail_authorize(current_user):
@@ -216,7 +290,9 @@ def gmail_authorize(current_user):
             scopes=[
                 'https://www.googleapis.com/auth/gmail.readonly',
                 'https://www.googleapis.com/auth/gmail.send',
-                'https://www.googleapis.com/auth/gmail.modify'
+                'https://www.googleapis.com/auth/gmail.modify',
+                'openid',
+                'https://www.googleapis.com/auth/userinfo.email'
             ]
         )
 
@@ -242,7 +318,6 @@ def gmail_authorize(current_user):
 
     except Exception as e:
         print(f"[AUTHORIZE ERROR] {type(e).__name__}: {e}", file=sys.stdout, flush=True)
-        print(f"[AUTHORIZE TRACE] {traceback.format_exc()}", file=sys.stdout, flush=True)
         logging.error(f"Gmail OAuth authorization failed: {e}", exc_info=True)
         return jsonify({"error": "Failed to initiate Gmail OAuth"}), 500
 
@@ -262,13 +337,7 @@ def gmail_callback():
         error = request.args.get('error')
         if error:
             print(f"[CALLBACK ERROR] Google returned error: {error}", file=sys.stdout, flush=True)
-            return f"""
-                <html><body style="font-family: Arial, sans-serif; text-align: center; padding: 50px;">
-                <h2>Authentication Failed</h2>
-                <p>Google Error: {error}</p>
-                <p>Please close this window and try again.</p>
-                </body></html>
-            """, 400
+            return _CALLBACK_FAILED_HTML % html.escape(f"Google Error: {error}"), 400
         
         # Get state from URL (Google returns it)
         state = request.args.get('state')
@@ -280,12 +349,7 @@ def gmail_callback():
         if not state:
             print(f"[CALLBACK ERROR] No state parameter!", file=sys.stdout, flush=True)
             logging.error("No state parameter in callback")
-            return """
-                <html><body style="font-family: Arial, sans-serif; text-align: center; padding: 50px;">
-                <h2>Authentication Failed</h2>
-                <p>Missing state parameter. Please try again.</p>
-                </body></html>
-            """, 400
+            return _CALLBACK_MISSING_STATE_HTML, 400
 
         # Retrieve user_id and session_id from DATABASE
         user_id, session_id = _get_oauth_state(state)
@@ -293,12 +357,7 @@ def gmail_callback():
         if not user_id:
             print(f"[CALLBACK ERROR] State not found in database!", file=sys.stdout, flush=True)
             logging.error(f"OAuth state not found in database: {state[:20]}...")
-            return """
-                <html><body style="font-family: Arial, sans-serif; text-align: center; padding: 50px;">
-                <h2>Authentication Failed</h2>
-                <p>Session expired or invalid. Please try again.</p>
-                </body></html>
-            """, 400
+            return _CALLBACK_INVALID_STATE_HTML, 400
 
         print(f"[CALLBACK] User ID: {user_id}, Session ID: {session_id}", file=sys.stdout, flush=True)
         logging.info(f"OAuth callback for user {user_id}, session {session_id}")
@@ -325,7 +384,9 @@ def gmail_callback():
             scopes=[
                 'https://www.googleapis.com/auth/gmail.readonly',
                 'https://www.googleapis.com/auth/gmail.send',
-                'https://www.googleapis.com/auth/gmail.modify'
+                'https://www.googleapis.com/auth/gmail.modify',
+                'openid',
+                'https://www.googleapis.com/auth/userinfo.email'
             ],
             state=state
         )
@@ -348,87 +409,31 @@ def gmail_callback():
             print(f"[CALLBACK] Token exchange successful!", file=sys.stdout, flush=True)
         except Exception as token_error:
             print(f"[CALLBACK TOKEN ERROR] {type(token_error).__name__}: {token_error}", file=sys.stdout, flush=True)
-            print(f"[CALLBACK TOKEN TRACE] {traceback.format_exc()}", file=sys.stdout, flush=True)
             raise
 
         credentials = flow.credentials
         print(f"[CALLBACK] Got credentials. Token: {'SET' if credentials.token else 'NOT SET'}, Refresh: {'SET' if credentials.refresh_token else 'NOT SET'}", file=sys.stdout, flush=True)
 
-        # Get user's Gmail email address
-        print(f"[CALLBACK] Fetching Gmail profile...", file=sys.stdout, flush=True)
-        gmail_service = build('gmail', 'v1', credentials=credentials)
-        profile = gmail_service.users().getProfile(userId='me').execute()
-        email_address = profile['emailAddress']
+        # The openid/email scopes return an ID token carrying the Gmail address,
+        # so no extra Gmail API round trip is needed to learn it
+        idinfo = id_token.verify_oauth2_token(credentials.id_token, _google_request, client_id)
+        email_address = idinfo['email']
         print(f"[CALLBACK] Gmail email: {email_address}", file=sys.stdout, flush=True)
 
-        # Store tokens in database
-        print(f"[CALLBACK] Storing tokens in database...", file=sys.stdout, flush=True)
-        conn = get_db_connection()
-        try:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO user_gmail_tokens (user_id, access_token, refresh_token, token_expiry, email_address)
-                VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT(user_id) DO UPDATE SET
-                    access_token = excluded.access_token,
-                    refresh_token = excluded.refresh_token,
-                    token_expiry = excluded.token_expiry,
-                    email_address = excluded.email_address,
-                    updated_at = CURRENT_TIMESTAMP
-            """, (
-                user_id,
-                credentials.token,
-                credentials.refresh_token,
-                credentials.expiry.isoformat() if credentials.expiry else None,
-                email_address
-            ))
-            conn.commit()
-            print(f"[CALLBACK] Tokens stored successfully!", file=sys.stdout, flush=True)
-            logging.info(f"Gmail tokens stored for user {user_id}, email: {email_address}")
-
-        finally:
-            return_db_connection(conn)
-
-        # Notify waiting email tool agent
-        if session_id:
-            try:
-                from tools.email_tool.agent import get_active_agent
-                agent = get_active_agent(user_id, session_id)
-                if agent:
-                    agent.set_auth_completed(True)
-                    print(f"[CALLBACK] Notified agent for user {user_id}, session {session_id}", file=sys.stdout, flush=True)
-                    logging.info(f"Notified agent for user {user_id}, session {session_id}")
-                else:
-                    print(f"[CALLBACK] No active agent for user {user_id}, session {session_id}", file=sys.stdout, flush=True)
-                    logging.info(f"No active agent for user {user_id}, session {session_id}")
-            except Exception as e:
-                print(f"[CALLBACK WARNING] Could not notify agent: {e}", file=sys.stdout, flush=True)
-                logging.warning(f"Could not notify agent: {e}")
+        # Token persistence and agent notification run in the background
+        # so the popup can close as soon as the code exchange succeeds
+        gevent.spawn(_finalize_gmail_connection, current_app._get_current_object(), user_id, session_id, credentials, email_address)
 
         print(f"[CALLBACK] ========== SUCCESS ==========", file=sys.stdout, flush=True)
         
         # Return success HTML
-        return f"""
-            <html><body style="font-family: Arial, sans-serif; text-align: center; padding: 50px;">
-            <h2>Gmail Connected!</h2>
-            <p>Connected as: {email_address}</p>
-            <p>This window will close automatically...</p>
-            <script>setTimeout(function(){{ window.close(); }}, 1500);</script>
-            </body></html>
-        """
+        return _CALLBACK_SUCCESS_HTML % html.escape(email_address)
 
     except Exception as e:
         print(f"[CALLBACK FATAL ERROR] {type(e).__name__}: {e}", file=sys.stdout, flush=True)
-        print(f"[CALLBACK FATAL TRACE] {traceback.format_exc()}", file=sys.stdout, flush=True)
         logging.error(f"Gmail OAuth callback failed: {e}", exc_info=True)
         error_msg = str(e) if str(e) else "Unknown error occurred"
-        return f"""
-            <html><body style="font-family: Arial, sans-serif; text-align: center; padding: 50px;">
-            <h2>Authentication Failed</h2>
-            <p>Error: {error_msg}</p>
-            <p>Please close this window and try again.</p>
-            </body></html>
-        """, 500
+        return _CALLBACK_FAILED_HTML % html.escape(f"Error: {error_msg}"), 500
 
 
 @auth_bp.route('/auth/gmail/status', methods=['GET'])
@@ -1,17 +1,28 @@
-﻿import json
+﻿import csv
+import functools
+import io
+import json
 import logging
+import orjson
 import re
-import tiktoken
+import string
+import time
 import asyncio
-from flask import Blueprint, request, jsonify, Response, stream_with_context, current_app
-from together import Together
+import gevent
+from gevent.pool import Pool
+from gevent.queue import Empty, Queue
+from gevent.threadpool import ThreadPoolExecutor
+from flask import Blueprint, request, jsonify, Response, stream_with_context, current_app, g
+from together_client import get_together_client
 from auth import optional_token_required
 from memory import TokenAwareMemoryManager
-from db import get_db_connection, get_unauthorized_request_count, increment_unauthorized_request_count, return_db_connection
+from db import StatementBatch, execute_prepared, get_db_connection, get_unauthorized_request_count, increment_unauthorized_request_count, reset_prepared_statements, return_db_connection
 from routes.together_key_routes import decrypt_key
+from psycopg2.extras import execute_values
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timezone
 import os
 
@@ -20,10 +31,53 @@ from tools import execute_tool, format_tool_result_for_llm
 
 chat_bp = Blueprint('chat_bp', __name__)
 
-THINK_TAG_REGEX = re.compile(r'<think>.*?</think>', re.DOTALL)
+# Exact default-mode tool call structure: {"tool_call": "search_web", "query": "..."}
+TOOL_CALL_REGEX = re.compile(r'\{\s*"tool_call"\s*:\s*"([^"]+)"\s*,\s*"query"\s*:\s*"([^"]+)"\s*\}')
+# orjson has no raw_decode, which the trailing-object fallback needs
+_JSON_DECODER = json.JSONDecoder()
+
+# Streamed tokens are batched into a single SSE frame at most every 20ms or 4096 chars
+SSE_FLUSH_INTERVAL = 0.02
+SSE_FLUSH_CHARS = 4096
+
+# Minimum gap between realtime search_web cache writes within one generation
+REALTIME_CACHE_MIN_INTERVAL = 0.5
+
+# SSE framing shared by every event the chat stream emits
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
+def sse_event(payload):
+    """Encode a payload as a single SSE data frame."""
+    return SSE_PREFIX + orjson.dumps(payload) + SSE_SUFFIX
+
+# reason is always normalized to one of these, so the completion frames are encoded once
+DONE_FRAMES = {mode: sse_event({'status': 'done', 'mode': mode}) for mode in ("code", "reason", "default")}
+# Only code mode parses model output as JSON, so this error frame never varies
+INVALID_JSON_FRAME = sse_event({'error': 'Invalid JSON generated', 'mode': 'code'})
+END_OF_STREAM_FRAME = b"event: end-of-stream\ndata: {}\n\n"
+
+def _pump_stream_deltas(stream, deltas):
+    """Move non-empty content deltas from a provider stream onto a queue, ending with StopIteration or the error."""
+    try:
+        for token_obj in stream:
+            if token_obj.choices:
+                delta = token_obj.choices[0].delta.content
+                if delta:
+                    deltas.put(delta)
+        deltas.put(StopIteration())
+    except Exception as e:
+        deltas.put(e)
+
+# The formatted date only changes once a day, so it is recomputed at most once a minute
+_DATE_CACHE = {"ts": float('-inf'), "val": ""}
 
 def current_date():
-    return datetime.now(timezone.utc).astimezone().strftime("%A, %B %d, %Y")
+    now = time.monotonic()
+    if now - _DATE_CACHE["ts"] >= 60:
+        _DATE_CACHE["val"] = datetime.now(timezone.utc).astimezone().strftime("%A, %B %d, %Y")
+        _DATE_CACHE["ts"] = now
+    return _DATE_CACHE["val"]
 
 BASE_SYSTEM_PROMPT = """
 # Core Instructions (DO NOT OVERRIDE)
@@ -216,6 +270,33 @@ Current Date: {today}
 User's Preferred Name: {user_name}
 """
 
+def _compile_prompt_template(template):
+    """Split a str.format template into (literal, field_name) segments once at import."""
+    return tuple((literal, field_name) for literal, field_name, _, _ in string.Formatter().parse(template))
+
+def _render_prompt_template(segments, values):
+    """Join pre-split template segments with their field values, skipping format-string parsing."""
+    parts = []
+    for literal, field_name in segments:
+        parts.append(literal)
+        if field_name is not None:
+            parts.append(str(values[field_name]))
+    return "".join(parts)
+
+_BASE_SYSTEM_PROMPT_SEGMENTS = _compile_prompt_template(BASE_SYSTEM_PROMPT)
+_CODE_SYSTEM_PROMPT_SEGMENTS = _compile_prompt_template(CODE_SYSTEM_PROMPT_TEMPLATE)
+
+# Rendered prompts only change with the date and the user's name/persona, so repeat requests reuse them
+@functools.lru_cache(maxsize=256)
+def render_base_system_prompt(today, user_name, user_persona):
+    """Render BASE_SYSTEM_PROMPT; equivalent to BASE_SYSTEM_PROMPT.format(...)."""
+    return _render_prompt_template(_BASE_SYSTEM_PROMPT_SEGMENTS, {"today": today, "user_name": user_name, "user_persona": user_persona})
+
+@functools.lru_cache(maxsize=256)
+def render_code_system_prompt(today, user_name):
+    """Render CODE_SYSTEM_PROMPT_TEMPLATE; equivalent to CODE_SYSTEM_PROMPT_TEMPLATE.format(...)."""
+    return _render_prompt_template(_CODE_SYSTEM_PROMPT_SEGMENTS, {"today": today, "user_name": user_name})
+
 # Enhanced Pydantic schemas with tool support
 class ToolCall(BaseModel):
     tool_name: str = Field(description="Name of the tool to call (e.g., 'search_web')")
@@ -236,17 +317,17 @@ class CodeResponse(BaseModel):
     tool_before_conclusion: Optional[ToolCall] = Field(default=None, description="Tool call before conclusion")
     Conclusion: Optional[str] = Field(default=None, description="Any text like explanation, description, conclusion, a guide, or anything else needed after project files")
 
+# Structured output format for code mode, built once since the schema never changes
+CODE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "schema": CodeResponse.model_json_schema(),
+}
+
 # Continuation prompt template
+# The original request and the response so far are already in the message history
+# (user turn and previous assistant turn), so continuations only carry the new tool data
 CONTINUATION_PROMPT_TEMPLATE = """[CONTINUATION CONTEXT]
 
-ORIGINAL USER REQUEST:
-"{original_query}"
-
-YOUR RESPONSE SO FAR (do NOT repeat this):
-\"\"\"
-{partial_response}
-\"\"\"
-
 TOOL CALL YOU JUST MADE:
 {tool_call_json}
 
@@ -255,8 +336,8 @@ TOOL RESULTS:
 
 ---
 CRITICAL INSTRUCTIONS:
-1. Review the ORIGINAL USER REQUEST above - that is your complete task
-2. You have already written the text in "YOUR RESPONSE SO FAR" - do NOT repeat it
+1. Review the ORIGINAL USER REQUEST (the user message before your previous replies) - that is your complete task
+2. You have already written the text in your previous assistant message - do NOT repeat it
 3. Use the tool results above to continue your response
 4. If the original request has multiple parts/steps, make sure to address ALL of them
 5. You can call additional tools if needed to fully complete the original request
@@ -268,11 +349,7 @@ Continue now:"""
 # Code mode continuation prompt
 CODE_CONTINUATION_PROMPT_TEMPLATE = """[CONTINUATION CONTEXT]
 
-ORIGINAL USER REQUEST:
-"{original_query}"
-
-YOUR JSON RESPONSE SO FAR:
-{partial_json}
+YOUR JSON RESPONSE SO FAR: your previous assistant message
 
 TOOL CALL YOU MADE (from field: {tool_field_name}):
 {tool_call_json}
@@ -283,7 +360,7 @@ TOOL RESULTS:
 ---
 **CRITICAL CONTINUATION INSTRUCTIONS:**
 
-1. Review ORIGINAL REQUEST - is it now fully answerable?
+1. Review the ORIGINAL REQUEST (the user message before your previous replies) - is it now fully answerable?
 2. Set "{tool_field_name}" to null (you already used it)
 3. Set ALL previously filled fields to null (Text, Files, etc. - do NOT repeat)
 4. Use tool results to continue populating remaining fields
@@ -314,16 +391,29 @@ def extract_file_content_from_bytes(file_bytes, mime_type):
     from routes.file_routes import extract_file_content_from_bytes as extract_func
     return extract_func(file_bytes, mime_type)
 
+# Shared keep-alive session so presigned B2 downloads reuse TCP/TLS connections
+_B2_HTTP_SESSION = requests.Session()
+_B2_HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16))
+
+def download_from_b2(b2_key):
+    """Download file from B2 using presigned URL."""
+    from routes.file_routes import generate_presigned_url
+    url = generate_presigned_url(b2_key, expiration=600)  # 10 minutes
+    if not url:
+        raise Exception(f"Failed to generate presigned URL for {b2_key}")
+
+    response = _B2_HTTP_SESSION.get(url, timeout=30)
+    response.raise_for_status()
+    return response.content
+
 def extract_text_from_pdf(file_path):
     """Extract text from PDF with error handling."""
     try:
         import pypdf
         with open(file_path, 'rb') as f:
             pdf_reader = pypdf.PdfReader(f)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text()
-            return text if text.strip() else "[PDF content could not be extracted]"
+            text = "\n".join(page.extract_text() or "" for page in pdf_reader.pages)
+            return text if text and not text.isspace() else "[PDF content could not be extracted]"
     except Exception as e:
         logging.warning(f"PDF extraction failed: {e}")
         return f"[PDF content extraction error: {str(e)}]"
@@ -333,8 +423,8 @@ def extract_text_from_docx(file_path):
     try:
         import docx
         doc = docx.Document(file_path)
-        text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-        return text if text.strip() else "[DOCX content could not be extracted]"
+        text = "\n".join(paragraph.text for paragraph in doc.paragraphs)
+        return text if text and not text.isspace() else "[DOCX content could not be extracted]"
     except Exception as e:
         logging.warning(f"DOCX extraction failed: {e}")
         return f"[DOCX content extraction error: {str(e)}]"
@@ -343,17 +433,22 @@ def extract_text_from_xlsx(file_path):
     """Extract text from XLSX with error handling."""
     try:
         import openpyxl
-        workbook = openpyxl.load_workbook(file_path)
-        text = ""
-        for sheet_name in workbook.sheetnames:
-            sheet = workbook[sheet_name]
-            text += f"Sheet: {sheet_name}\n"
-            for row in sheet.iter_rows(values_only=True):
-                row_text = ",".join([str(cell) if cell is not None else "" for cell in row])
-                if row_text.strip():
-                    text += row_text + "\n"
-            text += "\n"
-        return text if text.strip() else "[XLSX content could not be extracted]"
+        # read_only streams rows instead of loading the whole sheet
+        workbook = openpyxl.load_workbook(file_path, read_only=True)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        try:
+            for sheet_name in workbook.sheetnames:
+                buffer.write(f"Sheet: {sheet_name}\n")
+                writer.writerows(
+                    row for row in workbook[sheet_name].iter_rows(values_only=True)
+                    if any(cell is not None and cell != "" for cell in row)
+                )
+                buffer.write("\n")
+        finally:
+            workbook.close()
+        text = buffer.getvalue()
+        return text if text and not text.isspace() else "[XLSX content could not be extracted]"
     except Exception as e:
         logging.warning(f"XLSX extraction failed: {e}")
         return f"[XLSX content extraction error: {str(e)}]"
@@ -368,13 +463,14 @@ def extract_file_content(file_path, mime_type):
         elif mime_type == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
             return extract_text_from_xlsx(file_path)
         else:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
+            # Read the file once; the encoding fallbacks below decode the same bytes
+            with open(file_path, 'rb') as f:
+                raw_bytes = f.read()
+            return raw_bytes.decode('utf-8')
     except UnicodeDecodeError:
         for encoding in ['latin-1', 'cp1252', 'iso-8859-1']:
             try:
-                with open(file_path, 'r', encoding=encoding) as f:
-                    return f.read()
+                return raw_bytes.decode(encoding)
             except:
                 continue
         return "[Binary file - content not readable]"
@@ -396,35 +492,49 @@ def create_stitched_prompt(user_text, file_data_list):
     if not file_data_list:
         return f"[USER MESSAGE]\n{user_text}\n[ATTACHED FILES: 0]"
 
-    stitched = f"[USER MESSAGE]\n{user_text}\n[ATTACHED FILES: {len(file_data_list)}]\n"
+    parts = [f"[USER MESSAGE]\n{user_text}\n[ATTACHED FILES: {len(file_data_list)}]\n"]
 
     for idx, file_data in enumerate(file_data_list, 1):
         file_size_str = format_file_size(file_data['size'])
-        stitched += f"ΓöÇΓöÇΓöÇ FILE {idx}: {file_data['original_name']} ({file_data['mime_type']}, {file_size_str}) ΓöÇΓöÇΓöÇ\n"
-        stitched += f"{file_data['content']}\n"
-        stitched += f"ΓöÇΓöÇΓöÇ END FILE {idx} ΓöÇΓöÇΓöÇ\n"
-
-    return stitched
+        parts.append(f"ΓöÇΓöÇΓöÇ FILE {idx}: {file_data['original_name']} ({file_data['mime_type']}, {file_size_str}) ΓöÇΓöÇΓöÇ\n")
+        parts.append(f"{file_data['content']}\n")
+        parts.append(f"ΓöÇΓöÇΓöÇ END FILE {idx} ΓöÇΓöÇΓöÇ\n")
+
+    return "".join(parts)
+
+MODEL_TOKENIZER_MAP = {
+    "meta-llama/Llama-3.3-70B-Instruct-Turbo": "cl100k_base",
+    "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free": "cl100k_base",
+    "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo": "cl100k_base",
+    "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo": "cl100k_base",
+    "Qwen/Qwen3-235B-A22B-fp8-tput": "cl100k_base",
+    "Qwen/Qwen2.5-VL-72B-Instruct": "cl100k_base",
+    "Qwen/Qwen2.5-72B-Instruct-Turbo": "cl100k_base",
+    "Qwen/Qwen3-Coder-480B-A35B-Instruct-FP8": "cl100k_base",
+    "default": "cl100k_base"
+}
+
+# Loaded encoders keyed by encoding name, so each one is built once per worker
+_ENCODER_CACHE = {}
+
+def _get_encoder(encoding_name):
+    """Return a cached tiktoken encoder for the given encoding name."""
+    encoder = _ENCODER_CACHE.get(encoding_name)
+    if encoder is None:
+        # Imported on first use so workers that never count tokens skip loading it
+        import tiktoken
+        encoder = tiktoken.get_encoding(encoding_name)
+        _ENCODER_CACHE[encoding_name] = encoder
+    return encoder
 
 def get_tokenizer_for_model(model_name):
     """Get appropriate tokenizer for the model."""
     try:
-        model_tokenizer_map = {
-            "meta-llama/Llama-3.3-70B-Instruct-Turbo": "cl100k_base",
-            "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free": "cl100k_base",
-            "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo": "cl100k_base",
-            "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo": "cl100k_base",
-            "Qwen/Qwen3-235B-A22B-fp8-tput": "cl100k_base",
-            "Qwen/Qwen2.5-VL-72B-Instruct": "cl100k_base",
-            "Qwen/Qwen2.5-72B-Instruct-Turbo": "cl100k_base",
-            "Qwen/Qwen3-Coder-480B-A35B-Instruct-FP8": "cl100k_base",
-            "default": "cl100k_base"
-        }
-        encoding_name = model_tokenizer_map.get(model_name, "cl100k_base")
-        return tiktoken.get_encoding(encoding_name)
+        encoding_name = MODEL_TOKENIZER_MAP.get(model_name, "cl100k_base")
+        return _get_encoder(encoding_name)
     except Exception as e:
         logging.warning(f"Failed to get tokenizer for {model_name}: {e}. Using default.")
-        return tiktoken.get_encoding("cl100k_base")
+        return _get_encoder("cl100k_base")
 
 def count_tokens(text, model_name):
     """Count tokens in text using appropriate tokenizer for the model."""
@@ -432,31 +542,53 @@ def count_tokens(text, model_name):
         if not text or not isinstance(text, str):
             return 0
         tokenizer = get_tokenizer_for_model(model_name)
-        return len(tokenizer.encode(text))
+        # encode_ordinary skips the special-token scan and never raises on '<|...|>' text
+        return len(tokenizer.encode_ordinary(text))
     except Exception as e:
         logging.error(f"Token counting failed for model {model_name}: {e}")
         return max(1, len(text) // 4)
 
+def count_tokens_batch(texts, model_name):
+    """Count tokens for several texts in one native batch call; returns counts in input order."""
+    try:
+        tokenizer = get_tokenizer_for_model(model_name)
+        encodable = [text if text and isinstance(text, str) else "" for text in texts]
+        encoded = tokenizer.encode_ordinary_batch(encodable, num_threads=1)
+        return [len(tokens) for tokens in encoded]
+    except Exception as e:
+        logging.error(f"Batch token counting failed for model {model_name}: {e}")
+        return [max(1, len(text) // 4) if text and isinstance(text, str) else 0 for text in texts]
+
 def count_message_tokens(messages, model_name):
     """Count tokens in a list of messages."""
     try:
         total_tokens = 0
+        text_fragments = []
         for message in messages:
             total_tokens += 4
             content = message.get('content', '')
             if isinstance(content, str):
-                total_tokens += count_tokens(content, model_name)
+                text_fragments.append(content)
             elif isinstance(content, list):
                 for item in content:
                     if item.get('type') == 'text':
-                        total_tokens += count_tokens(item.get('text', ''), model_name)
+                        text_fragments.append(item.get('text', ''))
                     elif item.get('type') == 'image_url':
                         total_tokens += 765
+
+        # Encode every text fragment in one native batch call instead of one call per message
+        text_fragments = [text for text in text_fragments if text and isinstance(text, str)]
+        if text_fragments:
+            tokenizer = get_tokenizer_for_model(model_name)
+            # One thread: tiktoken would otherwise build a ThreadPoolExecutor (greenlets under gevent) per call
+            encoded = tokenizer.encode_ordinary_batch(text_fragments, num_threads=1)
+            total_tokens += sum(len(tokens) for tokens in encoded)
         return total_tokens
     except Exception as e:
         logging.error(f"Message token counting failed: {e}")
-        total_text = ' '.join([str(msg.get('content', '')) for msg in messages])
-        return max(10, len(total_text) // 4)
+        # Same length as the space-joined contents, without building that string
+        total_chars = sum(len(str(msg.get('content', ''))) for msg in messages) + max(len(messages) - 1, 0)
+        return max(10, total_chars // 4)
 
 def get_or_create_anonymous_user(session_id):
     """
@@ -467,31 +599,20 @@ def get_or_create_anonymous_user(session_id):
     try:
         cursor = conn.cursor()
         
-        # Check if we already have an anonymous user for this session_id
-        # We'll create a special email pattern for anonymous users
+        # Anonymous users get a special email pattern keyed by session_id
         anonymous_email = f"anonymous_{session_id}@anonymous.local"
         
-        # Try to get existing anonymous user
+        # Get or create in one atomic statement; the no-op update makes RETURNING fire on conflict
         cursor.execute(
-            "SELECT id FROM users WHERE email = %s",
-            (anonymous_email,)
+            """INSERT INTO users (email, username, password) VALUES (%s, %s, NULL)
+               ON CONFLICT (email) DO UPDATE SET email = EXCLUDED.email
+               RETURNING id""",
+            (anonymous_email, f"Anonymous_{session_id[:8]}")
         )
-        result = cursor.fetchone()
-        
-        if result:
-            return result['id']
-        
-        # Create a new anonymous user
-        cursor.execute(
-            "INSERT INTO users (email, username, password) VALUES (%s, %s, %s) RETURNING id",
-            (anonymous_email, f"Anonymous_{session_id[:8]}", None)
-        )
-        new_user = cursor.fetchone()
+        user = cursor.fetchone()
+        conn.commit()
         
-        if new_user:
-            return new_user['id']
-        else:
-            return None
+        return user['id'] if user else None
             
     except Exception as e:
         logging.error(f"Error creating anonymous user: {e}", exc_info=True)
@@ -499,24 +620,74 @@ def get_or_create_anonymous_user(session_id):
     finally:
         return_db_connection(conn)
 
-def check_user_token_limit(user_id):
+# Recently loaded (settings, used_tokens) per user: user_id -> (loaded_at, context)
+_USER_CONTEXT_CACHE = {}
+_USER_CONTEXT_CACHE_MAX = 4096
+USER_SETTINGS_CACHE_TTL = 30
+TOKEN_USAGE_CACHE_TTL = 5
+
+def invalidate_user_chat_context(user_id):
+    """Drop the cached chat context for a user after their settings or API key change."""
+    _USER_CONTEXT_CACHE.pop(user_id, None)
+
+def get_user_chat_context(user_id, max_age=USER_SETTINGS_CACHE_TTL):
     """
-    Check if user has exceeded their free token allotment.
-    Returns (has_exceeded, used_tokens, limit) tuple.
+    Load a user's chat settings and free-tier token usage in a single query.
+    The result is cached on flask.g for the request and across requests for up to max_age seconds.
+    Returns (settings_row_or_None, used_tokens) tuple.
     """
+    now = time.monotonic()
+    # The request memo keeps its load time, so a tighter max_age still forces a reload
+    cached = getattr(g, '_user_chat_context', None)
+    if cached is not None and cached[0] == user_id and now - cached[1] < max_age:
+        return cached[2]
+
+    entry = _USER_CONTEXT_CACHE.get(user_id)
+    if entry is not None and now - entry[0] < max_age:
+        g._user_chat_context = (user_id, entry[0], entry[1])
+        return entry[1]
+
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-
-        # Get total tokens used by this user
+        # Token usage only matters for users on the shared key, so skip the SUM for users with their own key
         cursor.execute(
-            """SELECT SUM(input_tokens + output_tokens) as total_tokens
-            FROM token_usage
-            WHERE user_id = %s""",
+            """SELECT s.user_id AS settings_user_id, s.temperature, s.top_p, s.system_prompt, s.what_we_call_you, s.together_api_key,
+                      CASE WHEN COALESCE(s.together_api_key, '') = ''
+                           THEN (SELECT SUM(input_tokens + output_tokens) FROM token_usage WHERE user_id = u.id)
+                           ELSE 0
+                      END AS used_tokens
+               FROM users u
+               LEFT JOIN user_settings s ON s.user_id = u.id
+               WHERE u.id = %s""",
             (user_id,)
         )
-        result = cursor.fetchone()
-        used_tokens = int(result['total_tokens'] or 0)
+        row = cursor.fetchone()
+    finally:
+        return_db_connection(conn)
+
+    used_tokens = int(row['used_tokens'] or 0) if row else 0
+    settings = row if row and row['settings_user_id'] is not None else None
+    context = (settings, used_tokens)
+    g._user_chat_context = (user_id, now, context)
+
+    if len(_USER_CONTEXT_CACHE) >= _USER_CONTEXT_CACHE_MAX:
+        # Drop everything already past the longest TTL before adding more
+        for stale_id in [uid for uid, (loaded_at, _) in _USER_CONTEXT_CACHE.items() if now - loaded_at >= USER_SETTINGS_CACHE_TTL]:
+            del _USER_CONTEXT_CACHE[stale_id]
+        if len(_USER_CONTEXT_CACHE) >= _USER_CONTEXT_CACHE_MAX:
+            _USER_CONTEXT_CACHE.clear()
+    _USER_CONTEXT_CACHE[user_id] = (now, context)
+    return context
+
+def check_user_token_limit(user_id):
+    """
+    Check if user has exceeded their free token allotment.
+    Returns (has_exceeded, used_tokens, limit) tuple.
+    """
+    try:
+        # Usage can only be a few seconds stale, so a user overshoots by at most one request
+        _, used_tokens = get_user_chat_context(user_id, max_age=TOKEN_USAGE_CACHE_TTL)
 
         # Get token limit from config
         token_limit = current_app.config['FREE_TOKEN_ALLOTMENT']
@@ -528,30 +699,26 @@ def check_user_token_limit(user_id):
     except Exception as e:
         logging.error(f"Error checking token limit: {e}", exc_info=True)
         return (False, 0, 0)  # Allow on error to avoid blocking users
-    finally:
-        return_db_connection(conn)
+
+@functools.lru_cache(maxsize=256)
+def _decrypt_together_key(enc_blob):
+    """Decrypt a stored Together key; keyed on the ciphertext, so a changed key is never served stale."""
+    return decrypt_key(enc_blob)
 
 def get_user_chat_settings(user_id):
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT temperature, top_p, system_prompt, what_we_call_you, together_api_key FROM user_settings WHERE user_id = %s", 
-            (user_id,)
-        )
-        settings = cursor.fetchone()
-        if settings:
-            return {
-                "temperature": settings['temperature'] if settings['temperature'] is not None else 0.7,
-                "top_p": settings['top_p'] if settings['top_p'] is not None else 1.0,
-                "system_prompt": settings['system_prompt'] or "You are a helpful assistant.",
-                "what_we_call_you": settings['what_we_call_you'] or "User",
-                "together_api_key": (decrypt_key(settings['together_api_key']) if settings['together_api_key'] else None)
-            }
-    finally:
-        return_db_connection(conn)
+    settings, _ = get_user_chat_context(user_id)
+    if settings:
+        return {
+            "temperature": settings['temperature'] if settings['temperature'] is not None else 0.7,
+            "top_p": settings['top_p'] if settings['top_p'] is not None else 1.0,
+            "system_prompt": settings['system_prompt'] or "You are a helpful assistant.",
+            "what_we_call_you": settings['what_we_call_you'] or "User",
+            "together_api_key": (_decrypt_together_key(settings['together_api_key']) if settings['together_api_key'] else None)
+        }
     return {"temperature": 0.7, "top_p": 1.0, "system_prompt": "You are a helpful assistant.", "what_we_call_you": "User", "together_api_key": None}
 
+VALID_REASONS = frozenset(("code", "reason", "default"))
+
 def validate_reason_parameter(reason):
     """Validate and normalize the reason parameter."""
     if reason is None:
@@ -560,7 +727,7 @@ def validate_reason_parameter(reason):
         return "reason" if reason else "default"
     if isinstance(reason, str):
         reason = reason.lower().strip()
-        if reason in ["code", "reason", "default"]:
+        if reason in VALID_REASONS:
             return reason
         else:
             logging.warning(f"Invalid reason parameter: {reason}. Defaulting to 'default'")
@@ -575,51 +742,49 @@ def detect_tool_call_in_default(text: str) -> Optional[Dict[str, Any]]:
     Returns tool call dict if found, None otherwise.
     """
     try:
-        text = text.strip()
+        # Most responses carry no tool call; a C-level substring scan rules them out cheaply
+        if '"tool_call"' not in text:
+            return None
 
-        # Pattern: exact match for tool call structure
-        # Looks for: {"tool_call": "search_web", "query": "..."}
-        pattern = r'\{\s*"tool_call"\s*:\s*"([^"]+)"\s*,\s*"query"\s*:\s*"([^"]+)"\s*\}'
+        # Work on index bounds rather than a stripped copy of the whole response
+        end = len(text)
+        while end and text[end - 1].isspace():
+            end -= 1
 
-        # Search from the end (last occurrence)
-        matches = list(re.finditer(pattern, text))
+        # Only the last tool call can be at the end, so anchor the match at the
+        # opening brace of the last "tool_call" key instead of scanning the whole text
+        key_pos = text.rfind('"tool_call"', 0, end)
+        brace_pos = text.rfind('{', 0, key_pos) if key_pos != -1 else -1
+        last_match = TOOL_CALL_REGEX.match(text, brace_pos, end) if brace_pos != -1 else None
 
-        if matches:
-            last_match = matches[-1]
+        if last_match:
             tool_name = last_match.group(1)
             query = last_match.group(2)
 
             # Verify it's actually at the end (allow trailing whitespace/punctuation)
-            remaining_text = text[last_match.end():].strip()
+            remaining_text = text[last_match.end():end].lstrip()
             if len(remaining_text) <= 2:  # Allow for trailing period or similar
                 return {
                     "tool_call": tool_name,
                     "query": query
                 }
 
-        # Fallback: try JSON parsing from the end
-        if text.endswith('}'):
-            brace_count = 0
-            json_start = -1
-            for i in range(len(text) - 1, -1, -1):
-                if text[i] == '}':
-                    brace_count += 1
-                elif text[i] == '{':
-                    brace_count -= 1
-                    if brace_count == 0:
-                        json_start = i
-                        break
-
-            if json_start != -1:
-                potential_json = text[json_start:]
+        # Fallback: find the object that parses cleanly up to the end of the text. It must hold
+        # the last "tool_call" key, so candidates start before it; raw_decode respects string
+        # literals, so braces or escaped quotes inside the query don't throw it off
+        if text.endswith('}', 0, end) and key_pos != -1:
+            json_start = text.rfind('{', 0, key_pos)
+            while json_start != -1:
                 try:
-                    parsed = json.loads(potential_json)
-                    if 'tool_call' in parsed and 'query' in parsed:
-                        # Verify these are the only keys or close to it
-                        if len(parsed) == 2:
-                            return parsed
+                    parsed, parsed_end = _JSON_DECODER.raw_decode(text, json_start)
                 except json.JSONDecodeError:
-                    pass
+                    parsed_end = -1
+                if parsed_end == end:
+                    # Only one object can close at the final brace
+                    if isinstance(parsed, dict) and 'tool_call' in parsed and 'query' in parsed and len(parsed) == 2:
+                        return parsed
+                    break
+                json_start = text.rfind('{', 0, json_start)
     except Exception as e:
         logging.debug(f"Tool call detection error: {e}")
 
@@ -631,12 +796,28 @@ def extract_text_before_tool_call(text: str) -> str:
     Extract text before tool call JSON, handling edge cases.
     """
     try:
-        # Use the same pattern as detection
-        pattern = r'\{\s*"tool_call"\s*:\s*"[^"]+"\s*,\s*"query"\s*:\s*"[^"]+"\s*\}'
-
-        matches = list(re.finditer(pattern, text))
-        if matches:
-            last_match = matches[-1]
+        if '"tool_call"' not in text:
+            return text
+
+        # Common case: the last compact tool call object is a full match that closes the response
+        head, sep, _ = text.rpartition('{"tool_call"')
+        if sep:
+            tail_match = TOOL_CALL_REGEX.match(text, len(head))
+            if tail_match and tail_match.end() == len(text.rstrip()):
+                return head.strip()
+
+        # Walk "tool_call" keys from the end and try the pattern at each one's opening
+        # brace; the first hit is the last match a full left-to-right scan would find
+        last_match = None
+        key_pos = len(text)
+        while last_match is None:
+            key_pos = text.rfind('"tool_call"', 0, key_pos)
+            if key_pos == -1:
+                break
+            brace_pos = text.rfind('{', 0, key_pos)
+            if brace_pos != -1:
+                last_match = TOOL_CALL_REGEX.match(text, brace_pos)
+        if last_match:
             return text[:last_match.start()].strip()
 
         # Fallback
@@ -673,29 +854,54 @@ def detect_tool_call_in_code(json_obj: Dict[str, Any]) -> Optional[tuple]:
 
     return None
 
+def strip_think_tags(text: str) -> str:
+    """Remove <think>...</think> reasoning blocks and surrounding whitespace from a response."""
+    # Reasoning models emit a single leading block; split on it instead of running the regex
+    head, sep, tail = text.partition('</think>')
+    if sep and head.lstrip().startswith('<think>') and head.count('<think>') == 1 and '<think>' not in tail:
+        return tail.strip()
+    # Single forward pass with str.find: an unclosed <think> cannot trigger a rescan to the end per tag
+    parts = []
+    pos = 0
+    while True:
+        start = text.find('<think>', pos)
+        if start == -1:
+            break
+        end = text.find('</think>', start + 7)
+        if end == -1:
+            break
+        parts.append(text[pos:start])
+        pos = end + 8
+    parts.append(text[pos:])
+    return ''.join(parts).strip()
+
+
 def merge_json_responses(responses: List[Dict[str, Any]]) -> Dict[str, Any]:
     """
     Merge multiple JSON responses, keeping last non-null value for each field.
     """
     merged = {}
+    files = None
 
     for response in responses:
         for key, value in response.items():
-            if value is not None:
-                if key == 'Files' and isinstance(value, list):
-                    # Special handling for Files array
-                    if 'Files' not in merged:
-                        merged['Files'] = []
-
-                    for file_obj in value:
-                        if file_obj is not None:
-                            # Remove tool fields before merging
-                            clean_file = {k: v for k, v in file_obj.items() if v is not None}
-                            if clean_file:
-                                merged['Files'].append(clean_file)
-                else:
-                    # Keep ALL fields including tool fields for history
-                    merged[key] = value
+            if value is None:
+                continue
+            if key == 'Files' and isinstance(value, list):
+                # Files from every response are concatenated and cleaned once at the end
+                if files is None:
+                    files = merged['Files'] = []
+                files.extend(file_obj for file_obj in value if file_obj)
+            else:
+                # Keep ALL fields including tool fields for history
+                merged[key] = value
+
+    if files is not None:
+        # Drop null fields (unused tool slots) from each file in place; the parsed dicts belong to this merge
+        for file_obj in files:
+            for null_key in [k for k, v in file_obj.items() if v is None]:
+                del file_obj[null_key]
+        files[:] = [file_obj for file_obj in files if file_obj]
 
     return merged
 
@@ -723,7 +929,7 @@ def extract_essential_search_results(tavily_response: Dict[str, Any]) -> Dict[st
                 'index': idx,  # ΓåÉ NEW: Citation index
                 'title': result.get('title', ''),
                 'url': result.get('url', ''),
-                'content': result.get('content', '')[:1000]  # Limit to 1000 chars
+                'content': (result.get('content') or '')[:1000]  # Limit to 1000 chars
             })
 
     return essential
@@ -746,11 +952,12 @@ def extract_urls_from_tavily_response(tavily_response: Dict[str, Any]) -> List[D
     
     return urls
 
-def store_search_web_urls(user_id, session_id, chat_history_id, search_calls):
+def store_search_web_urls(cursor, user_id, session_id, chat_history_id, search_calls):
     """
-    Store search_web URLs in database.
+    Store search_web URLs in database. Runs on the caller's transaction; the caller commits.
     
     Args:
+        cursor: Cursor (or StatementBatch) on the finalization connection
         user_id: User ID
         session_id: Session number
         chat_history_id: Chat history record ID
@@ -759,31 +966,31 @@ def store_search_web_urls(user_id, session_id, chat_history_id, search_calls):
     if not search_calls:
         return
     
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        for idx, call in enumerate(search_calls):
-            cursor.execute(
-                """INSERT INTO search_web_logs
-                   (user_id, session_number, chat_history_id, call_sequence, query, urls_json, timestamp)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s)""",
-                (user_id, int(session_id), chat_history_id, idx, 
-                 call['query'], json.dumps(call['urls']), call['timestamp'])
-            )
-        conn.commit()
-        logging.info(f"Stored {len(search_calls)} search_web URL logs for chat_history_id {chat_history_id}")
-    except Exception as e:
-        conn.rollback()
-        logging.error(f"Failed to store search_web URLs: {e}", exc_info=True)
-    finally:
-        return_db_connection(conn)
-
-
-def store_email_tool_data(user_id, session_id, chat_history_id, email_tool_data):
+    session_number = int(session_id)
+    rows = [
+        (user_id, session_number, chat_history_id, idx,
+         call['query'], orjson.dumps(call['urls']).decode(), call['timestamp'])
+        for idx, call in enumerate(search_calls)
+    ]
+    # One multi-row INSERT instead of a round-trip per call
+    execute_values(
+        cursor,
+        """INSERT INTO search_web_logs
+           (user_id, session_number, chat_history_id, call_sequence, query, urls_json, timestamp)
+           VALUES %s""",
+        rows,
+        page_size=100
+    )
+    logging.info("Stored %d search_web URL logs for chat_history_id %s", len(search_calls), chat_history_id)
+
+
+def store_email_tool_data(cursor, user_id, session_id, chat_history_id, email_tool_data):
     """
     Store email_tool execution data in database for history UI reconstruction.
+    Runs on the caller's transaction; the caller commits.
     
     Args:
+        cursor: Cursor (or StatementBatch) on the finalization connection
         user_id: User ID
         session_id: Session number
         chat_history_id: Chat history record ID
@@ -792,28 +999,79 @@ def store_email_tool_data(user_id, session_id, chat_history_id, email_tool_data)
     if not email_tool_data:
         return
     
-    conn = get_db_connection()
+    # Prepared once per pooled connection, so repeat inserts skip parse/plan
+    execute_prepared(
+        cursor,
+        "insert_email_tool_log",
+        """INSERT INTO email_tool_logs
+           (user_id, session_number, chat_history_id, query, success, total_iterations, summary, iterations_json, timestamp)
+           VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)""",
+        (user_id, int(session_id), chat_history_id, 
+         email_tool_data.get('query', ''),
+         email_tool_data.get('success', True),
+         email_tool_data.get('total_iterations', 0),
+         email_tool_data.get('summary', ''),
+         orjson.dumps(email_tool_data.get('iterations', [])).decode(),
+         email_tool_data.get('timestamp', datetime.now(timezone.utc).isoformat()))
+    )
+    logging.info("Stored email_tool data for chat_history_id %s", chat_history_id)
+
+
+
+def _persist_chat_turn(app, user_id, session_id, chat_history_id, file_ids, search_web_calls, email_tool_data):
+    """Write a finished turn's file links and tool logs, and clear its realtime cache."""
+    with app.app_context():
+        has_links = chat_history_id is not None and bool(file_ids or search_web_calls or email_tool_data)
+        # Only search_web calls populate the realtime cache, so without them there is nothing to clear
+        if has_links or search_web_calls:
+            _write_chat_turn_records(user_id, session_id, chat_history_id if has_links else None,
+                                     file_ids, search_web_calls, email_tool_data)
+
+
+def _write_chat_turn_records(user_id, session_id, chat_history_id, file_ids, search_web_calls, email_tool_data):
+    """Link files and tool logs to chat_history_id (when set) and clear the session's realtime cache."""
+    # File links, tool logs and the realtime cache cleanup share one connection and commit,
+    # and are sent to the server together as a single batch
+    conn = None
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            """INSERT INTO email_tool_logs
-               (user_id, session_number, chat_history_id, query, success, total_iterations, summary, iterations_json, timestamp)
-               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
-            (user_id, int(session_id), chat_history_id, 
-             email_tool_data.get('query', ''),
-             email_tool_data.get('success', True),
-             email_tool_data.get('total_iterations', 0),
-             email_tool_data.get('summary', ''),
-             json.dumps(email_tool_data.get('iterations', [])),
-             email_tool_data.get('timestamp', datetime.now(timezone.utc).isoformat()))
-        )
+        conn = get_db_connection()
+        batch = StatementBatch(conn.cursor())
+        if chat_history_id is not None:
+            # Link files to chat; unnest keeps one prepared statement for any number of files
+            if file_ids:
+                execute_prepared(
+                    batch,
+                    "link_chat_files",
+                    "INSERT INTO chat_files (chat_history_id, file_id) SELECT $1::integer, unnest($2::integer[])",
+                    (chat_history_id, list(file_ids))
+                )
+            store_search_web_urls(batch, user_id, session_id, chat_history_id, search_web_calls)
+            store_email_tool_data(batch, user_id, session_id, chat_history_id, email_tool_data)
+
+        if search_web_calls:
+            # Clear search_web realtime cache from database
+            execute_prepared(
+                batch,
+                "clear_realtime_cache",
+                "DELETE FROM search_web_realtime_cache WHERE user_id = $1 AND session_number = $2",
+                (user_id, int(session_id))
+            )
+        batch.flush()
         conn.commit()
-        logging.info(f"Stored email_tool data for chat_history_id {chat_history_id}")
+        if search_web_calls:
+            logging.info("Cleared realtime cache for session %s", session_id)
     except Exception as e:
-        conn.rollback()
-        logging.error(f"Failed to store email_tool data: {e}", exc_info=True)
+        if conn:
+            conn.rollback()
+            # A queued PREPARE may never have reached the server, so start this connection over
+            try:
+                reset_prepared_statements(conn)
+            except Exception:
+                logging.warning("Failed to reset prepared statements", exc_info=True)
+        logging.error(f"Failed to finalize chat records: {e}", exc_info=True)
     finally:
-        return_db_connection(conn)
+        if conn:
+            return_db_connection(conn)
 
 
 @chat_bp.route('/chat', methods=['POST'])
@@ -849,33 +1107,48 @@ def chat(current_user):
             conn = get_db_connection()
             try:
                 cursor = conn.cursor()
-                placeholders = ','.join(['%s'] * len(file_ids))
+                # A single array parameter keeps the SQL text constant whatever the file count
                 cursor.execute(
-                    f"""SELECT id, b2_key, original_name, size, mime_type, is_image
+                    """SELECT id, b2_key, original_name, size, mime_type, is_image
                        FROM uploaded_files
-                       WHERE id IN ({placeholders})""",
-                    file_ids
+                       WHERE id = ANY(%s)""",
+                    (list(file_ids),)
                 )
                 files = cursor.fetchall()
-                # Helper function to download from B2
-                def download_from_b2(b2_key):
-                    """Download file from B2 using presigned URL."""
-                    from routes.file_routes import generate_presigned_url
-                    url = generate_presigned_url(b2_key, expiration=600)  # 10 minutes
-                    if not url:
-                        raise Exception(f"Failed to generate presigned URL for {b2_key}")
-    
-                    response = requests.get(url, timeout=30)
-                    response.raise_for_status()
-                    return response.content
 
-                for file_record in files:
+                app = current_app._get_current_object()
+
+                def fetch_file(file_record):
+                    # Pool greenlets don't inherit the request's app context
+                    with app.app_context():
+                        if file_record['is_image']:
+                            # The model fetches the image from the same presigned URL we would download
+                            # from, so pass the URL instead of downloading and inlining it as base64
+                            from routes.file_routes import generate_presigned_url
+                            presigned_url = generate_presigned_url(file_record['b2_key'], expiration=600)
+                            if not presigned_url:
+                                return None, None, Exception(f"Failed to generate presigned URL for {file_record['b2_key']}")
+                            return presigned_url, None, None
+                        try:
+                            file_bytes = download_from_b2(file_record['b2_key'])
+                        except Exception as e:
+                            return None, None, e
+                    # Parse on a native thread as soon as this file arrives, overlapping
+                    # with the remaining downloads; waiting on the future only blocks this greenlet
+                    content = extract_executor.submit(extract_file_content_from_bytes, file_bytes, file_record['mime_type']).result()
+                    return file_bytes, content, None
+
+                # Downloads are network-bound, so run them concurrently on greenlets, while
+                # CPU-bound parsing runs on native threads so it doesn't stall the gevent hub
+                workers = min(8, len(files)) or 1
+                with ThreadPoolExecutor(max_workers=workers) as extract_executor:
+                    results = Pool(workers).map(fetch_file, files)
+
+                for file_record, (file_payload, content, download_error) in zip(files, results):
                     b2_key = file_record['b2_key']
-    
-                    try:
-                        file_bytes = download_from_b2(b2_key)
-                    except Exception as e:
-                        logging.error(f"Failed to download file from B2: {b2_key}, error: {e}", exc_info=True)
+
+                    if download_error is not None:
+                        logging.error(f"Failed to download file from B2: {b2_key}, error: {download_error}", exc_info=download_error)
                         file_data_list.append({
                             'id': file_record['id'],
                             'b2_key': b2_key,
@@ -887,12 +1160,9 @@ def chat(current_user):
                         continue
 
                     if file_record['is_image']:
-                        import base64
-                        encoded = base64.b64encode(file_bytes).decode('utf-8')
-                        image_url = f"data:{file_record['mime_type']};base64,{encoded}"
+                        image_url = file_payload
                         is_vision_request = True
                     else:
-                        content = extract_file_content_from_bytes(file_bytes, file_record['mime_type'])
                         logging.info(f"Extracted content from {file_record['original_name']}: {len(content)} characters")
                         file_data_list.append({
                             'id': file_record['id'],
@@ -901,7 +1171,7 @@ def chat(current_user):
                             'size': file_record['size'],
                             'mime_type': file_record['mime_type'],
                             'content': content
-                        })    
+                        })
             finally:
                 return_db_connection(conn)
 
@@ -927,7 +1197,7 @@ def chat(current_user):
         }), 401
 
     memory = TokenAwareMemoryManager(user_id, session_id)
-    client = Together(api_key=api_key)
+    client = get_together_client(api_key)
     original_prompt = query
 
     # Determine model and prepare messages
@@ -947,17 +1217,17 @@ def chat(current_user):
 
         if reason == "code":
             model_name = current_app.config['CODE_LLM']
-            final_system_prompt = CODE_SYSTEM_PROMPT_TEMPLATE.format(today=current_date(), user_name=chat_settings['what_we_call_you'])
+            final_system_prompt = render_code_system_prompt(today=current_date(), user_name=chat_settings['what_we_call_you'])
         elif reason == "reason":
             model_name = current_app.config['REASON_LLM']
-            final_system_prompt = BASE_SYSTEM_PROMPT.format(
+            final_system_prompt = render_base_system_prompt(
                 today=current_date(),
                 user_name=chat_settings['what_we_call_you'],
                 user_persona=chat_settings['system_prompt']
             )
         else:
             model_name = current_app.config['DEFAULT_LLM']
-            final_system_prompt = BASE_SYSTEM_PROMPT.format(
+            final_system_prompt = render_base_system_prompt(
                 today=current_date(),
                 user_name=chat_settings['what_we_call_you'],
                 user_persona=chat_settings['system_prompt']
@@ -973,24 +1243,120 @@ def chat(current_user):
         # Track responses for code mode merging
         code_mode_responses = []
 
-        # For default mode, track cumulative response
-        default_mode_full_response = ""
+        # For default mode, track each model turn and join once at finalization
+        default_mode_turns = []
+        partial_response = ""
+        # Output tokens of those turns, counted as each turn completes; the default branch stores them as-is
+        default_mode_output_tokens = 0
+        count_turn_tokens = reason == "default" or is_vision_request
 
         search_web_calls = []  # Track search_web executions: [{query, urls, timestamp}]
         email_tool_data = None  # Track email_tool execution: {query, success, total_iterations, summary, iterations, timestamp}
 
+        realtime_cache_written_at = float('-inf')
+        realtime_cache_dirty = False
+
+        def update_realtime_cache(force=False):
+            """Upsert search_web_calls into the realtime cache, at most once per REALTIME_CACHE_MIN_INTERVAL."""
+            nonlocal realtime_cache_written_at, realtime_cache_dirty
+            now = time.monotonic()
+            if not force and now - realtime_cache_written_at < REALTIME_CACHE_MIN_INTERVAL:
+                # Picked up before the next model turn starts
+                realtime_cache_dirty = True
+                return
+            conn = None
+            try:
+                conn = get_db_connection()
+                cursor = conn.cursor()
+                execute_prepared(
+                    cursor,
+                    "upsert_realtime_cache",
+                    """INSERT INTO search_web_realtime_cache (user_id, session_number, calls_json, updated_at)
+                        VALUES ($1, $2, $3, NOW())
+                        ON CONFLICT (user_id, session_number) 
+                        DO UPDATE SET calls_json = EXCLUDED.calls_json, updated_at = NOW()""",
+                    (user_id, int(session_id), orjson.dumps(search_web_calls).decode())
+                )
+                conn.commit()
+                realtime_cache_written_at = now
+                realtime_cache_dirty = False
+                logging.info("Updated realtime cache for session %s with %d calls", session_id, len(search_web_calls))
+            except Exception as e:
+                logging.error(f"Failed to update realtime cache: {e}", exc_info=True)
+            finally:
+                if conn:
+                    return_db_connection(conn)
+
+        # Token frames only vary in the token text, so the mode tail is encoded once
+        token_frame_suffix = b',"mode":' + orjson.dumps(reason) + b'}' + SSE_SUFFIX
+
+        def record_tool_result(tool_name, tool_query, tool_result):
+            """Track successful search_web/email_tool results for the realtime cache and history persistence."""
+            nonlocal email_tool_data
+            if not tool_result.get('success'):
+                return
+            if tool_name == 'search_web':
+                urls = extract_urls_from_tavily_response(tool_result['result'])
+                search_web_calls.append({
+                    'query': tool_query,
+                    'urls': urls,
+                    'timestamp': datetime.now(timezone.utc).isoformat()
+                })
+                logging.info(f"Captured {len(urls)} URLs from search_web call #{len(search_web_calls)}")
+                # Mirror to the database cache for cross-worker polling (debounced)
+                update_realtime_cache()
+            elif tool_name == 'email_tool':
+                result_data = tool_result.get('result', {})
+                email_tool_data = {
+                    'query': tool_query,
+                    'success': result_data.get('success', True),
+                    'total_iterations': result_data.get('total_iterations', 0),
+                    'summary': result_data.get('summary', ''),
+                    'iterations': result_data.get('iterations', []),
+                    'timestamp': datetime.now(timezone.utc).isoformat()
+                }
+                logging.info(f"Captured email_tool data with {email_tool_data['total_iterations']} iterations")
+
+        tool_loop = None
+
+        def run_tool(tool_name, tool_query):
+            """Run execute_tool on one event loop shared by every tool call in this generation."""
+            nonlocal tool_loop
+            if tool_loop is None:
+                tool_loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(tool_loop)
+            return tool_loop.run_until_complete(
+                execute_tool(tool_name, {'query': tool_query}, user_id=user_id, session_id=str(session_id), socketio_instance=current_app.socketio if hasattr(current_app, 'socketio') else None, client_context=client_context)
+            )
+
+        def finalize_interaction(mode_label, memory_query, final_response, full_response_for_history=None, output_token_count=None):
+            """Count tokens for the finished turn and record it in memory."""
+            if output_token_count is None:
+                input_token_count, output_token_count = count_tokens_batch([memory_query, final_response], model_name)
+            else:
+                input_token_count = count_tokens(memory_query, model_name)
+
+            memory.add_interaction(memory_query, final_response, input_token_count, output_token_count,
+                                   full_response_for_history=full_response_for_history,
+                                   original_prompt=original_prompt)
+
+            logging.info("Added %s interaction with tool usage: %d tokens", mode_label, output_token_count)
+
         try:
             # Main tool loop
             while tool_call_count < max_tool_calls:
-                chunks = []
-                current_messages = messages.copy()
+                if realtime_cache_dirty:
+                    update_realtime_cache(force=True)
+                # One growing buffer per model turn instead of a list of every delta
+                response_buf = io.StringIO()
 
-                logging.info(f"Tool loop iteration {tool_call_count + 1}, mode: {reason}")
+                logging.info("Tool loop iteration %d, mode: %s", tool_call_count + 1, reason)
 
                 # Prepare request parameters
                 request_params = {
                     "model": model_name,
-                    "messages": current_messages,
+                    # Sent as-is: the client only reads it, and continuations are appended after the stream ends
+                    "messages": messages,
                     "temperature": chat_settings['temperature'],
                     "top_p": chat_settings['top_p'],
                     "max_tokens": 10000,
@@ -998,26 +1364,48 @@ def chat(current_user):
                 }
 
                 if reason == "code":
-                    request_params["response_format"] = {
-                        "type": "json_schema",
-                        "schema": CodeResponse.model_json_schema(),
-                    }
+                    request_params["response_format"] = CODE_RESPONSE_FORMAT
 
                 # Stream response
                 stream = client.chat.completions.create(**request_params)
-                import sys
-                for token_obj in stream:
-                    if token_obj.choices:
-                        delta = token_obj.choices[0].delta.content or ''
-                        chunks.append(delta)
-                        data = f"data: {json.dumps({'token': delta, 'mode': reason})}\n\n".encode()
-                        yield data
-                        # force flush to prevent buffering...
-                        try: 
-                            sys.stdout.flush()
-                        except: 
+                # Under the gevent worker each yield is handed straight to the socket; the
+                # X-Accel-Buffering header keeps proxies from holding chunks back
+                # Tokens are coalesced into one frame per SSE_FLUSH_INTERVAL or SSE_FLUSH_CHARS
+                pending = []
+                pending_len = 0
+                last_flush = time.monotonic()
+                # The stream is read on its own greenlet so buffered tokens are flushed when the
+                # interval runs out, even if the provider stalls before sending the next chunk
+                deltas = Queue()
+                pump = gevent.spawn(_pump_stream_deltas, stream, deltas)
+                try:
+                    while True:
+                        timeout = max(0, SSE_FLUSH_INTERVAL - (time.monotonic() - last_flush)) if pending else None
+                        try:
+                            delta = deltas.get(timeout=timeout)
+                        except Empty:
                             pass
-                partial_response = ''.join(chunks).strip()
+                        else:
+                            if isinstance(delta, StopIteration):
+                                break
+                            if isinstance(delta, Exception):
+                                raise delta
+                            response_buf.write(delta)
+                            pending.append(delta)
+                            pending_len += len(delta)
+                        now = time.monotonic()
+                        if pending and (pending_len >= SSE_FLUSH_CHARS or now - last_flush >= SSE_FLUSH_INTERVAL):
+                            yield SSE_PREFIX + b'{"token":' + orjson.dumps(''.join(pending)) + token_frame_suffix
+                            pending = []
+                            pending_len = 0
+                            last_flush = now
+                            # Already-queued deltas never block, so hand other streams on this worker a turn
+                            gevent.sleep(0)
+                finally:
+                    pump.kill()
+                if pending:
+                    yield SSE_PREFIX + b'{"token":' + orjson.dumps(''.join(pending)) + token_frame_suffix
+                partial_response = response_buf.getvalue().strip()
 
                 if not partial_response:
                     logging.warning("Empty response received, breaking tool loop")
@@ -1027,10 +1415,11 @@ def chat(current_user):
                 if reason == "code":
                     # Code mode: detect tool in JSON
                     try:
-                        json_response = json.loads(partial_response)
+                        json_response = orjson.loads(partial_response)
                         code_mode_responses.append(json_response)
 
-                        tool_detection = detect_tool_call_in_code(json_response)
+                        # Null tool slots are always serialized; only a real call carries a "tool_name" key
+                        tool_detection = detect_tool_call_in_code(json_response) if '"tool_name"' in partial_response else None
 
                         if tool_detection:
                             field_name, tool_call_data = tool_detection
@@ -1040,56 +1429,11 @@ def chat(current_user):
                             logging.info(f"Tool call detected in code mode: {tool_name} from field {field_name}")
 
                             # Send tool call event
-                            yield f"data: {json.dumps({'event': 'tool_call', 'tool_name': tool_name, 'mode': reason})}\n\n".encode()
+                            yield sse_event({'event': 'tool_call', 'tool_name': tool_name, 'mode': reason})
 
                             # Execute tool
-                            loop = asyncio.new_event_loop()
-                            asyncio.set_event_loop(loop)
-                            tool_result = loop.run_until_complete(
-                                execute_tool(tool_name, {'query': tool_query}, user_id=user_id, session_id=str(session_id), socketio_instance=current_app.socketio if hasattr(current_app, 'socketio') else None, client_context=client_context)
-                            )
-                            loop.close()
-                            # Track search_web URLs
-                            if tool_name == 'search_web' and tool_result.get('success'):
-                                urls = extract_urls_from_tavily_response(tool_result['result'])
-                                search_web_calls.append({
-                                    'query': tool_query,
-                                    'urls': urls,
-                                    'timestamp': datetime.now(timezone.utc).isoformat()
-                                })
-                                logging.info(f"Captured {len(urls)} URLs from search_web call #{len(search_web_calls)}")
-                                # After capturing URLs, add to database cache for cross-worker access
-                                if search_web_calls:
-                                    try:
-                                        conn = get_db_connection()
-                                        cursor = conn.cursor()
-                                        cursor.execute(
-                                            """INSERT INTO search_web_realtime_cache (user_id, session_number, calls_json, updated_at)
-                                                VALUES (%s, %s, %s, NOW())
-                                                ON CONFLICT (user_id, session_number) 
-                                                DO UPDATE SET calls_json = EXCLUDED.calls_json, updated_at = NOW()""",
-                                            (user_id, int(session_id), json.dumps(search_web_calls))
-                                        )   
-                                        conn.commit()
-                                        logging.info(f"Updated realtime cache for session {session_id} with {len(search_web_calls)} calls")
-                                        return_db_connection(conn)
-                                    except Exception as e:
-                                        logging.error(f"Failed to update realtime cache: {e}", exc_info=True)
-                                        if conn:
-                                            return_db_connection(conn)
-
-                            # Track email_tool data for history persistence
-                            if tool_name == 'email_tool' and tool_result.get('success'):
-                                result_data = tool_result.get('result', {})
-                                email_tool_data = {
-                                    'query': tool_query,
-                                    'success': result_data.get('success', True),
-                                    'total_iterations': result_data.get('total_iterations', 0),
-                                    'summary': result_data.get('summary', ''),
-                                    'iterations': result_data.get('iterations', []),
-                                    'timestamp': datetime.now(timezone.utc).isoformat()
-                                }
-                                logging.info(f"Captured email_tool data with {email_tool_data['total_iterations']} iterations")
+                            tool_result = run_tool(tool_name, tool_query)
+                            record_tool_result(tool_name, tool_query, tool_result)
 
                             if not tool_result.get('success'):
                                 logging.error(f"Tool execution failed: {tool_result.get('error')}")
@@ -1102,11 +1446,9 @@ def chat(current_user):
                             essential_results = tool_result.get('result', tool_result) if tool_name == 'email_tool' else extract_essential_search_results(tool_result['result'])
                             # Prepare continuation prompt
                             continuation_prompt = CODE_CONTINUATION_PROMPT_TEMPLATE.format(
-                                original_query=original_prompt,
-                                partial_json=json.dumps(json_response, indent=2),
                                 tool_field_name=field_name,
-                                tool_call_json=json.dumps(tool_call_data, indent=2),
-                                tool_result_json=json.dumps(essential_results, indent=2)
+                                tool_call_json=orjson.dumps(tool_call_data, option=orjson.OPT_INDENT_2).decode(),
+                                tool_result_json=orjson.dumps(essential_results, option=orjson.OPT_INDENT_2).decode()
                             )
 
                             # Add continuation to messages
@@ -1119,21 +1461,23 @@ def chat(current_user):
                             # No more tool calls, response complete
                             break
 
-                    except json.JSONDecodeError as e:
+                    except orjson.JSONDecodeError as e:
                         logging.error(f"Invalid JSON in code mode: {e}")
-                        yield f"data: {json.dumps({'error': 'Invalid JSON generated', 'mode': reason})}\n\n".encode()
+                        yield INVALID_JSON_FRAME
                         break
 
                 else:
                     # Default/Reason mode: detect tool call at end
-                    default_mode_full_response += partial_response
+                    default_mode_turns.append(partial_response)
+                    if count_turn_tokens:
+                        default_mode_output_tokens += count_tokens(partial_response, model_name)
 
                     tool_call_data = detect_tool_call_in_default(partial_response)
 
                     if tool_call_data:
                         logging.info(f"=== TOOL CALL DETECTION START ===")
                         logging.info(f"Raw tool_call_data type: {type(tool_call_data)}")
-                        logging.info(f"Raw tool_call_data: {tool_call_data}")
+                        logging.info("Raw tool_call_data: %s", tool_call_data)
                         logging.info(f"tool_call_data keys: {list(tool_call_data.keys()) if isinstance(tool_call_data, dict) else 'NOT A DICT'}")
 
                         tool_name = tool_call_data.get('tool_call')
@@ -1147,7 +1491,7 @@ def chat(current_user):
                         text_before_tool = extract_text_before_tool_call(partial_response)
 
                         # Send tool call event
-                        yield f"data: {json.dumps({'event': 'tool_call', 'tool_name': tool_name, 'mode': reason})}\n\n".encode()
+                        yield sse_event({'event': 'tool_call', 'tool_name': tool_name, 'mode': reason})
 
                         # Execute tool
                         # Execute tool with detailed error handling
@@ -1155,63 +1499,20 @@ def chat(current_user):
                             logging.info(f"=== TOOL EXECUTION START ===")
                             logging.info(f"Calling execute_tool with: tool_name={tool_name}, query={tool_query}")
 
-                            loop = asyncio.new_event_loop()
-                            asyncio.set_event_loop(loop)
-                            tool_result = loop.run_until_complete(
-                                execute_tool(tool_name, {'query': tool_query}, user_id=user_id, session_id=str(session_id), socketio_instance=current_app.socketio if hasattr(current_app, 'socketio') else None, client_context=client_context)
-                            )
-                            loop.close()
-                            # Track search_web URLs
-                            if tool_name == 'search_web' and tool_result.get('success'):
-                                urls = extract_urls_from_tavily_response(tool_result['result'])
-                                search_web_calls.append({
-                                    'query': tool_query,
-                                    'urls': urls,
-                                    'timestamp': datetime.now(timezone.utc).isoformat()
-                                })
-                                logging.info(f"Captured {len(urls)} URLs from search_web call #{len(search_web_calls)}")
-                                # After capturing URLs, add to database cache for cross-worker access
-                                if search_web_calls:
-                                    try:
-                                        conn = get_db_connection()
-                                        cursor = conn.cursor()
-                                        cursor.execute(
-                                            """INSERT INTO search_web_realtime_cache (user_id, session_number, calls_json, updated_at)
-                                                VALUES (%s, %s, %s, NOW())
-                                                ON CONFLICT (user_id, session_number) 
-                                                DO UPDATE SET calls_json = EXCLUDED.calls_json, updated_at = NOW()""",
-                                            (user_id, int(session_id), json.dumps(search_web_calls))
-                                        )
-                                        conn.commit()
-                                        logging.info(f"Updated realtime cache for session {session_id} with {len(search_web_calls)} calls")
-                                        return_db_connection(conn)
-                                    except Exception as e:
-                                        logging.error(f"Failed to update realtime cache: {e}", exc_info=True)
-                                        if conn:
-                                            return_db_connection(conn)
-
-                            # Track email_tool data for history persistence
-                            if tool_name == 'email_tool' and tool_result.get('success'):
-                                result_data = tool_result.get('result', {})
-                                email_tool_data = {
-                                    'query': tool_query,
-                                    'success': result_data.get('success', True),
-                                    'total_iterations': result_data.get('total_iterations', 0),
-                                    'summary': result_data.get('summary', ''),
-                                    'iterations': result_data.get('iterations', []),
-                                    'timestamp': datetime.now(timezone.utc).isoformat()
-                                }
-                                logging.info(f"Captured email_tool data with {email_tool_data['total_iterations']} iterations")
-
-                            logging.info(f"Tool result type: {type(tool_result)}")
-                            logging.info(f"Tool result keys: {list(tool_result.keys()) if isinstance(tool_result, dict) else 'NOT A DICT'}")
-                            logging.info(f"Tool result: {tool_result}")
+                            tool_result = run_tool(tool_name, tool_query)
+                            record_tool_result(tool_name, tool_query, tool_result)
+
+                            logging.info("Tool result type: %s", type(tool_result))
+                            logging.info("Tool result keys: %s", list(tool_result.keys()) if isinstance(tool_result, dict) else 'NOT A DICT')
+                            # The full result can be a large Tavily/email payload; only render it when debugging
+                            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                                logging.debug("Tool result: %s", tool_result)
                             logging.info(f"=== TOOL EXECUTION END ===")
 
                             if not tool_result.get('success'):
                                 logging.error(f"Tool execution failed: {tool_result.get('error')}")
                                 error_msg = f"\n\n*[Tool execution failed: {tool_result.get('error', 'Unknown error')}]*"
-                                yield f"data: {json.dumps({'token': error_msg, 'mode': reason})}\n\n".encode()
+                                yield sse_event({'token': error_msg, 'mode': reason})
                                 break
 
                         except Exception as tool_exec_error:
@@ -1219,7 +1520,7 @@ def chat(current_user):
                             logging.error(f"Error type: {type(tool_exec_error)}")
                             logging.error(f"Error message: {str(tool_exec_error)}")
                             error_msg = f"\n\n*[Tool execution crashed: {str(tool_exec_error)}]*"
-                            yield f"data: {json.dumps({'token': error_msg, 'mode': reason})}\n\n".encode()
+                            yield sse_event({'token': error_msg, 'mode': reason})
                             break
 
                         tool_call_count += 1
@@ -1228,9 +1529,10 @@ def chat(current_user):
                         # Prepare continuation prompt with error handling
                         try:
                             logging.info(f"=== CONTINUATION PROMPT CREATION START ===")
-                            logging.info(f"original_prompt: {original_prompt[:100]}...")
+                            # User text stays out of INFO logs
+                            logging.debug("original_prompt: %.100s...", original_prompt)
                             logging.info(f"text_before_tool length: {len(text_before_tool)}")
-                            logging.info(f"tool_call_data: {tool_call_data}")
+                            logging.info("tool_call_data: %s", tool_call_data)
 
                             # Check tool_result structure
                             if 'result' in tool_result:
@@ -1244,14 +1546,16 @@ def chat(current_user):
                             # Extract only essential search results
                             essential_results = tool_result.get('result', tool_result) if tool_name == 'email_tool' else extract_essential_search_results(tool_result['result'])
 
+                            tool_result_json = orjson.dumps(essential_results, option=orjson.OPT_INDENT_2).decode()  # ΓåÉ MUCH SMALLER!
                             continuation_prompt = CONTINUATION_PROMPT_TEMPLATE.format(
-                                original_query=original_prompt,
-                                partial_response=text_before_tool,
-                                tool_call_json=json.dumps(tool_call_data, indent=2),
-                                tool_result_json=json.dumps(essential_results, indent=2)  # ΓåÉ MUCH SMALLER!
+                                tool_call_json=orjson.dumps(tool_call_data, option=orjson.OPT_INDENT_2).decode(),
+                                tool_result_json=tool_result_json
                             )
 
-                            logging.info(f"Essential results size: {len(json.dumps(essential_results))} chars (vs full: {len(json.dumps(tool_result['result']))} chars)")
+                            # The full result is only sized by its result contents rather than re-serialized
+                            full_results = tool_result_data.get('results') if isinstance(tool_result_data, dict) else None
+                            full_content_size = sum(len(r.get('content') or '') for r in full_results or [])
+                            logging.info(f"Essential results size: {len(tool_result_json)} chars (vs full result contents: {full_content_size} chars)")
 
                             logging.info(f"Continuation prompt created successfully, length: {len(continuation_prompt)}")
                             logging.info(f"=== CONTINUATION PROMPT CREATION END ===")
@@ -1259,7 +1563,7 @@ def chat(current_user):
                         except KeyError as ke:
                             logging.error(f"!!! KEYERROR IN CONTINUATION PROMPT !!!", exc_info=True)
                             logging.error(f"Missing key: {ke}")
-                            logging.error(f"tool_result structure: {tool_result}")
+                            logging.error("tool_result structure: %s", tool_result)
                             raise
                         except Exception as cont_error:
                             logging.error(f"!!! CONTINUATION PROMPT CREATION CRASHED !!!", exc_info=True)
@@ -1284,181 +1588,66 @@ def chat(current_user):
         except Exception as e:
             logging.error(f"Streaming error: {e}", exc_info=True)
             error_response = {'error': 'Generation failed', 'details': str(e), 'mode': reason}
-            yield f"data: {json.dumps(error_response)}\n\n".encode()
+            yield sse_event(error_response)
 
         finally:
+            if tool_loop is not None:
+                tool_loop.close()
             if generation_completed_normally:
-                # Save to memory based on mode
+                default_mode_full_response = ''.join(default_mode_turns)
+                base_memory_query = stitched_prompt if file_data_list else original_prompt
+                # Save to memory based on mode; each branch only picks what to store
                 if reason == "code" and code_mode_responses:
                     # Merge all JSON responses
                     final_json = merge_json_responses(code_mode_responses)
-                    final_response = json.dumps(final_json, indent=2)
-
-                    memory_query = stitched_prompt if file_data_list else original_prompt
-                    input_token_count = count_tokens(memory_query, model_name)
-                    output_token_count = count_tokens(final_response, model_name)
-
-                    memory.add_interaction(memory_query, final_response, input_token_count, output_token_count, original_prompt=original_prompt)
-
-                    # Link files to chat
-                    if current_user:
-                        conn = get_db_connection()
-                        try:
-                            cursor = conn.cursor()
-                            cursor.execute(
-                                """SELECT id FROM chat_history
-                                   WHERE user_id = %s AND session_number = %s
-                                   ORDER BY id DESC LIMIT 1""",
-                                (user_id, session_id)
-                            )
-                            result = cursor.fetchone()
-                            if not result: 
-                                logging.warning(f"No chat history found for user {user_id}, session {session_id}")
-                                return_db_connection(conn)
-                                return
-
-                            last_chat_id = result['id']
-                            if file_data_list:
-                                for file_data in file_data_list:
-                                    cursor.execute(
-                                        "INSERT INTO chat_files (chat_history_id, file_id) VALUES (%s, %s)",
-                                        (last_chat_id, file_data['id'])
-                                    )
-                            conn.commit()
-                        finally:
-                            return_db_connection(conn)
-
-                            # Store search_web URLs
-                        if search_web_calls:
-                            store_search_web_urls(user_id, session_id, last_chat_id, search_web_calls)
-                        
-                        # Store email_tool data
-                        if email_tool_data:
-                            store_email_tool_data(user_id, session_id, last_chat_id, email_tool_data)
-
-                    logging.info(f"Added code interaction with tool usage: {output_token_count} tokens")
+                    # Stored compact: still valid JSON, fewer bytes to tokenize and write
+                    final_response = orjson.dumps(final_json).decode()
+                    finalize_interaction("code", base_memory_query, final_response)
 
                 elif reason == "reason" and not is_vision_request:
-                    cleaned_answer = THINK_TAG_REGEX.sub('', default_mode_full_response).strip()
-                    memory_query = stitched_prompt if file_data_list else original_prompt
-                    input_token_count = count_tokens(memory_query, model_name)
-                    output_token_count = count_tokens(cleaned_answer, model_name)
-
-                    memory.add_interaction(memory_query, cleaned_answer, input_token_count, output_token_count,
-                                         full_response_for_history=default_mode_full_response,
-                                         original_prompt=original_prompt)
-
-                    # Link files
-                    if current_user:
-                        conn = get_db_connection()
-                        try:
-                            cursor = conn.cursor()
-                            cursor.execute(
-                                """SELECT id FROM chat_history
-                                   WHERE user_id = %s AND session_number = %s
-                                   ORDER BY id DESC LIMIT 1""",
-                                (user_id, session_id)
-                            ) 
-                            result = cursor.fetchone()
-                            if not result:  # ADD THIS CHECK
-                                logging.warning(f"No chat history found for user {user_id}, session {session_id}")
-                                return_db_connection(conn)
-                                return
-
-                            last_chat_id = result['id']
-                            if file_data_list:
-                                for file_data in file_data_list:
-                                    cursor.execute(
-                                        "INSERT INTO chat_files (chat_history_id, file_id) VALUES (%s, %s)",
-                                        (last_chat_id, file_data['id'])
-                                    )
-                            conn.commit()
-                        finally:
-                            return_db_connection(conn)
-
-                        # Store search_web URLs
-                        if search_web_calls:
-                            store_search_web_urls(user_id, session_id, last_chat_id, search_web_calls)
-                        
-                        # Store email_tool data
-                        if email_tool_data:
-                            store_email_tool_data(user_id, session_id, last_chat_id, email_tool_data)
-
-                    logging.info(f"Added reasoning interaction with tool usage: {output_token_count} tokens")
+                    cleaned_answer = strip_think_tags(default_mode_full_response)
+                    finalize_interaction("reasoning", base_memory_query, cleaned_answer,
+                                         full_response_for_history=default_mode_full_response)
 
                 else:
                     # Default mode or vision
-                    final_response = default_mode_full_response if default_mode_full_response else ''.join(chunks).strip()
-                    memory_query = f"[Image Analysis] {original_prompt}" if is_vision_request else (stitched_prompt if file_data_list else original_prompt)
+                    memory_query = f"[Image Analysis] {original_prompt}" if is_vision_request else base_memory_query
+                    if default_mode_full_response and count_turn_tokens:
+                        finalize_interaction("default", memory_query, default_mode_full_response,
+                                             output_token_count=default_mode_output_tokens)
+                    else:
+                        # partial_response already holds the stripped text of the last turn
+                        finalize_interaction("default", memory_query, default_mode_full_response or partial_response)
 
-                    input_token_count = count_tokens(memory_query, model_name)
-                    output_token_count = count_tokens(final_response, model_name)
+            else:
+                logging.info("Generation for session %s did not complete normally.", session_id)
 
-                    memory.add_interaction(memory_query, final_response, input_token_count, output_token_count, original_prompt=original_prompt)
+            chat_history_id = None
+            if generation_completed_normally and current_user:
+                chat_history_id = memory.last_chat_id
+                if chat_history_id is None:
+                    logging.warning(f"No chat history found for user {user_id}, session {session_id}")
 
-                    # Link files
-                    if current_user:
-                        conn = get_db_connection()
-                        try:
-                            cursor = conn.cursor()
-                            cursor.execute(
-                                """SELECT id FROM chat_history
-                                   WHERE user_id = %s AND session_number = %s
-                                   ORDER BY id DESC LIMIT 1""",
-                                (user_id, session_id)
-                            )
-                            result = cursor.fetchone()
-                            if not result: 
-                                logging.warning(f"No chat history found for user {user_id}, session {session_id}")
-                                return_db_connection(conn)
-                                return
-
-                            last_chat_id = result['id']
-                            if file_data_list:
-                                for file_data in file_data_list:
-                                    cursor.execute(
-                                        "INSERT INTO chat_files (chat_history_id, file_id) VALUES (%s, %s)",
-                                        (last_chat_id, file_data['id'])
-                                    )
-                            conn.commit()
-                        finally:
-                            return_db_connection(conn)
-
-                        # Store search_web URLs
-                        if search_web_calls:
-                            store_search_web_urls(user_id, session_id, last_chat_id, search_web_calls)
-                        
-                        # Store email_tool data
-                        if email_tool_data:
-                            store_email_tool_data(user_id, session_id, last_chat_id, email_tool_data)
-
-                    logging.info(f"Added default interaction with tool usage: {output_token_count} tokens")
-
-                memory.save_to_db()
+            if generation_completed_normally:
+                # Saved before the stream ends so the session's next request loads this turn
+                try:
+                    memory.save_to_db()
+                except Exception as e:
+                    logging.error(f"Failed to save memory for session {session_id}: {e}", exc_info=True)
+
+            # Link and log bookkeeping runs in the background so end-of-stream isn't held up by it
+            gevent.spawn(
+                _persist_chat_turn, current_app._get_current_object(), user_id, session_id, chat_history_id,
+                [file_data['id'] for file_data in file_data_list], search_web_calls, email_tool_data
+            )
 
+            if generation_completed_normally:
                 # Send memory stats and completion
                 memory_stats = memory.get_memory_stats()
                 memory_stats['mode'] = reason
-                yield f"data: {json.dumps({'memory_stats': memory_stats})}\n\n".encode()
-                yield f"data: {json.dumps({'status': 'done', 'mode': reason})}\n\n".encode()
-            else:
-                logging.info(f"Generation for session {session_id} did not complete normally.")
-            # Clear search_web realtime cache from database
-            try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute(
-                    "DELETE FROM search_web_realtime_cache WHERE user_id = %s AND session_number = %s",
-                    (user_id, int(session_id))
-                )
-                conn.commit()
-                logging.info(f"Cleared realtime cache for session {session_id}")
-                return_db_connection(conn)
-            except Exception as e:
-                logging.error(f"Failed to clear realtime cache: {e}", exc_info=True)
-                if conn:
-                    return_db_connection(conn)
-            yield b"event: end-of-stream\ndata: {}\n\n"
+                yield sse_event({'memory_stats': memory_stats})
+                yield DONE_FRAMES[reason]
+            yield END_OF_STREAM_FRAME
 
     headers = {
         "Content-Type": "text/event-stream",
@@ -1,6 +1,8 @@
 ﻿import os
 import io
+import csv
 import logging
+import threading
 import uuid
 from datetime import datetime, timezone
 from flask import Blueprint, request, jsonify, current_app
@@ -28,6 +30,16 @@ except ImportError:
     HAS_PYPDF = False
     logging.warning("pypdf not available. PDF processing will be disabled.")
 
+try:
+    import pypdfium2
+    HAS_PDFIUM = True
+except ImportError:
+    HAS_PDFIUM = False
+    logging.info("pypdfium2 not available. PDF text extraction will use pypdf.")
+
+# PDFium is not thread-safe; extraction runs on the native thread pool and request greenlets
+_PDFIUM_LOCK = threading.Lock()
+
 try:
     import docx
     HAS_DOCX = True
@@ -174,16 +186,33 @@ def generate_presigned_url(b2_key, expiration=3600):
         logging.error(f"Failed to generate presigned URL: {e}", exc_info=True)
         return None
 
+def _extract_pdf_text_pdfium(file_content_bytes):
+    """Extract PDF text with PDFium, one document at a time."""
+    with _PDFIUM_LOCK:
+        pdf = pypdfium2.PdfDocument(file_content_bytes)
+        try:
+            parts = []
+            for page in pdf:
+                textpage = page.get_textpage()
+                parts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+    # PDFium separates lines with CRLF
+    return "\n".join(parts).replace("\r\n", "\n")
+
 def extract_text_from_pdf(file_content_bytes):
     """Extract text from PDF bytes."""
     try:
+        if HAS_PDFIUM:
+            text = _extract_pdf_text_pdfium(file_content_bytes)
+            return text if text and not text.isspace() else "[PDF content could not be extracted]"
         import pypdf
         pdf_file = io.BytesIO(file_content_bytes)
         pdf_reader = pypdf.PdfReader(pdf_file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text()
-        return text if text.strip() else "[PDF content could not be extracted]"
+        text = "\n".join(page.extract_text() or "" for page in pdf_reader.pages)
+        return text if text and not text.isspace() else "[PDF content could not be extracted]"
     except Exception as e:
         logging.warning(f"PDF extraction failed: {e}")
         return f"[PDF content extraction error: {str(e)}]"
@@ -194,8 +223,8 @@ def extract_text_from_docx(file_content_bytes):
         import docx
         docx_file = io.BytesIO(file_content_bytes)
         doc = docx.Document(docx_file)
-        text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-        return text if text.strip() else "[DOCX content could not be extracted]"
+        text = "\n".join(paragraph.text for paragraph in doc.paragraphs)
+        return text if text and not text.isspace() else "[DOCX content could not be extracted]"
     except Exception as e:
         logging.warning(f"DOCX extraction failed: {e}")
         return f"[DOCX content extraction error: {str(e)}]"
@@ -205,17 +234,22 @@ def extract_text_from_xlsx(file_content_bytes):
     try:
         import openpyxl
         xlsx_file = io.BytesIO(file_content_bytes)
-        workbook = openpyxl.load_workbook(xlsx_file)
-        text = ""
-        for sheet_name in workbook.sheetnames:
-            sheet = workbook[sheet_name]
-            text += f"Sheet: {sheet_name}\n"
-            for row in sheet.iter_rows(values_only=True):
-                row_text = ",".join([str(cell) if cell is not None else "" for cell in row])
-                if row_text.strip():
-                    text += row_text + "\n"
-            text += "\n"
-        return text if text.strip() else "[XLSX content could not be extracted]"
+        # read_only streams rows instead of loading the whole sheet
+        workbook = openpyxl.load_workbook(xlsx_file, read_only=True)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        try:
+            for sheet_name in workbook.sheetnames:
+                buffer.write(f"Sheet: {sheet_name}\n")
+                writer.writerows(
+                    row for row in workbook[sheet_name].iter_rows(values_only=True)
+                    if any(cell is not None and cell != "" for cell in row)
+                )
+                buffer.write("\n")
+        finally:
+            workbook.close()
+        text = buffer.getvalue()
+        return text if text and not text.isspace() else "[XLSX content could not be extracted]"
     except Exception as e:
         logging.warning(f"XLSX extraction failed: {e}")
         return f"[XLSX content extraction error: {str(e)}]"
@@ -6,7 +6,7 @@ from db import get_db_connection, return_db_connection
 import uuid
 from werkzeug.security import generate_password_hash, check_password_hash
 from psycopg2.extras import RealDictCursor # realdictcursor.
-import json
+import orjson
 
 
 
@@ -88,10 +88,10 @@ def get_full_session_history(current_user, session_number):
                     search_web_calls.append({
                         'sequence': log['call_sequence'],
                         'query': log['query'],
-                        'urls': json.loads(log['urls_json']),
+                        'urls': orjson.loads(log['urls_json']),
                         'timestamp': log['timestamp']
                     })
-                except (json.JSONDecodeError, TypeError) as e:
+                except (orjson.JSONDecodeError, TypeError) as e:
                     logging.warning(f"Failed to parse search_web URLs for chat_id {chat_id}: {e}")
 
             # Get email_tool data for this chat interaction
@@ -112,10 +112,10 @@ def get_full_session_history(current_user, session_number):
                         'success': email_log['success'],
                         'total_iterations': email_log['total_iterations'],
                         'summary': email_log['summary'],
-                        'iterations': json.loads(email_log['iterations_json']),
+                        'iterations': orjson.loads(email_log['iterations_json']),
                         'timestamp': email_log['timestamp']
                     }
-                except (json.JSONDecodeError, TypeError) as e:
+                except (orjson.JSONDecodeError, TypeError) as e:
                     logging.warning(f"Failed to parse email_tool data for chat_id {chat_id}: {e}")
 
             history.append({
@@ -497,10 +497,10 @@ def get_shared_conversation(share_id):
                     search_web_calls.append({
                         'sequence': log['call_sequence'],
                         'query': log['query'],
-                        'urls': json.loads(log['urls_json']),
+                        'urls': orjson.loads(log['urls_json']),
                         'timestamp': log['timestamp']
                     })
-                except (json.JSONDecodeError, TypeError) as e:
+                except (orjson.JSONDecodeError, TypeError) as e:
                     logging.warning(f"Failed to parse search_web URLs for chat_id {chat_id}: {e}")
 
             # Get email_tool data for this chat interaction
@@ -521,10 +521,10 @@ def get_shared_conversation(share_id):
                         'success': email_log['success'],
                         'total_iterations': email_log['total_iterations'],
                         'summary': email_log['summary'],
-                        'iterations': json.loads(email_log['iterations_json']),
+                        'iterations': orjson.loads(email_log['iterations_json']),
                         'timestamp': email_log['timestamp']
                     }
-                except (json.JSONDecodeError, TypeError) as e:
+                except (orjson.JSONDecodeError, TypeError) as e:
                     logging.warning(f"Failed to parse email_tool data for chat_id {chat_id}: {e}")
 
             history.append({
@@ -576,13 +576,13 @@ def get_search_web_urls(current_user, session_number):
         
         if result:
             try:
-                calls = json.loads(result['calls_json'])
+                calls = orjson.loads(result['calls_json'])
                 return jsonify({
                     'active': True,
                     'calls': calls,
                     'count': len(calls)
                 }), 200
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 logging.error(f"Failed to decode calls_json for session {session_number}")
                 return jsonify({
                     'active': True,
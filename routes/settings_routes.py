@@ -83,6 +83,9 @@ def update_user_settings(current_user):
         cursor.execute(query, tuple(values))
         conn.commit()
 
+        from routes.chat import invalidate_user_chat_context
+        invalidate_user_chat_context(user_id)
+
         return jsonify({"message": "Settings updated successfully"}), 200
 
     except Exception as e:
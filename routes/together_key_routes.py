@@ -47,6 +47,11 @@ def decrypt_key(enc_blob: str) -> str:
         raise
 
 # ---- DB helpers ----
+def _invalidate_chat_context(user_id: int):
+    # Imported lazily: routes.chat imports this module
+    from routes.chat import invalidate_user_chat_context
+    invalidate_user_chat_context(user_id)
+
 def set_user_together_key(user_id: int, enc_blob: str):
     conn = get_db_connection()
     try:
@@ -57,6 +62,7 @@ def set_user_together_key(user_id: int, enc_blob: str):
             # No row updated -> insert
             cur.execute("INSERT INTO user_settings (user_id, together_api_key) VALUES (%s, %s)", (user_id, enc_blob))
         conn.commit()
+        _invalidate_chat_context(user_id)
         logging.info(f"Successfully stored Together API key for user {user_id}")
     finally:
         return_db_connection(conn)
@@ -77,6 +83,7 @@ def delete_user_together_key(user_id: int):
         cur = conn.cursor()
         cur.execute("UPDATE user_settings SET together_api_key = NULL WHERE user_id = %s", (user_id,))
         conn.commit()
+        _invalidate_chat_context(user_id)
         logging.info(f"Successfully deleted Together API key for user {user_id}")
     finally:
         return_db_connection(conn)
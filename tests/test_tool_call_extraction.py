@@ -0,0 +1,14 @@
+from routes.chat import extract_text_before_tool_call
+
+
+def test_compact_tool_call_at_end_is_stripped():
+    text = 'Let me look that up. {"tool_call": "search_web", "query": "news"}'
+    assert extract_text_before_tool_call(text) == 'Let me look that up.'
+
+
+def test_earlier_compact_example_is_not_taken_for_the_trailing_call():
+    text = ('Answer: use {"tool_call": "search_web", "query": "x"} format.\n'
+            'Let me search. { "tool_call": "search_web", "query": "news" }')
+    assert extract_text_before_tool_call(text) == (
+        'Answer: use {"tool_call": "search_web", "query": "x"} format.\nLet me search.'
+    )
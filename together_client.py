@@ -0,0 +1,33 @@
+"""
+Shared Together AI clients.
+
+Clients are cached per API key so chat, memory summarization and the email tool
+reuse one client (and its keep-alive HTTP connection pool) instead of building a
+new one per request.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Keyed by a hash of the API key so raw keys are not kept as dict keys
+_TOGETHER_CLIENTS = OrderedDict()
+_TOGETHER_CLIENT_CACHE_SIZE = 32
+_TOGETHER_CLIENTS_LOCK = threading.Lock()
+
+
+def get_together_client(api_key):
+    """Return a reusable Together client for the API key, evicting the least recently used one."""
+    cache_key = hashlib.sha256(api_key.encode()).hexdigest()
+    with _TOGETHER_CLIENTS_LOCK:
+        client = _TOGETHER_CLIENTS.get(cache_key)
+        if client is None:
+            # Deferred so importing this module does not pull in the SDK
+            from together import Together
+            client = Together(api_key=api_key)
+            _TOGETHER_CLIENTS[cache_key] = client
+            if len(_TOGETHER_CLIENTS) > _TOGETHER_CLIENT_CACHE_SIZE:
+                _TOGETHER_CLIENTS.popitem(last=False)
+        else:
+            _TOGETHER_CLIENTS.move_to_end(cache_key)
+        return client
@@ -113,8 +113,8 @@ class EmailToolAgent:
                 self.socketio.emit(event, data, room=self.room)
                 logging.info(f"WebSocket SENT to room: {event} to room {self.room}")
 
-                # Give gevent a chance to actually send the messages
-                gevent.sleep(0.1)
+                # Yield to the hub so the emit is flushed, without adding a fixed timer delay
+                gevent.sleep(0)
 
             except Exception as e:
                 logging.error(f"WebSocket EMIT ERROR: {event} to room {self.room}: {e}", exc_info=True)
@@ -5,7 +5,7 @@ Handles Together AI inference with structured JSON output support.
 
 import json
 import logging
-from together import Together
+from together_client import get_together_client
 from flask import current_app
 from typing import Dict, Any, List
 from .schemas import get_schema_for_iteration
@@ -30,7 +30,7 @@ class EmailToolLLMClient:
         if not api_key:
             raise ValueError("TOGETHER_API_KEY not provided and not found in app config")
         
-        self.client = Together(api_key=api_key)
+        self.client = get_together_client(api_key)
         self.model = current_app.config.get('DEFAULT_LLM', 'Qwen/Qwen3-235B-A22B-Instruct-2507-tput')
         
         logging.info(f"EmailToolLLMClient initialized with model: {self.model}")
@@ -3,12 +3,26 @@ Tavily Web Search Tool Implementation
 Provides real-time web search capabilities using Tavily API.
 """
 
+import functools
 import logging
 import asyncio
 from typing import Dict, Any
 from tavily import TavilyClient
 from flask import current_app
 
+# Only the fields chat.py reads (query, answer, result title/url/content) are requested;
+# raw page content and images would multiply the payload without being used
+SEARCH_OPTIONS = {
+    "search_depth": "basic",
+    "include_raw_content": False,
+    "include_images": False,
+}
+
+@functools.lru_cache(maxsize=4)
+def _get_tavily_client(api_key):
+    """Return a TavilyClient reused across searches instead of building one per call."""
+    return TavilyClient(api_key=api_key)
+
 async def search_web_tool(tool_input: Dict[str, Any]) -> Dict[str, Any]:
     """
     Execute web search using Tavily API.
@@ -40,13 +54,12 @@ async def search_web_tool(tool_input: Dict[str, Any]) -> Dict[str, Any]:
     try:
         # Tavily client is synchronous, so we run it in executor
         loop = asyncio.get_event_loop()
-        tavily_client = TavilyClient(api_key=api_key)
+        tavily_client = _get_tavily_client(api_key)
 
         # Run blocking call in thread pool
         response = await loop.run_in_executor(
             None,
-            tavily_client.search,
-            query
+            functools.partial(tavily_client.search, query, **SEARCH_OPTIONS)
         )
 
         logging.info(f"Web search completed successfully. Found {len(response.get('results', []))} results")